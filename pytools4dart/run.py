@@ -338,7 +338,7 @@ def upgrade(simu_name):
     rundart(simu_name, 'XMLUpgrader')
 
 
-def dart2las(simudir, las_file = None, type='bin', lasFormat=None, extra_bytes=True, **kwargs):
+def dart2las(simudir, las_file = None, type='bin', lasFormat=None, extra_bytes=True, ncpu=1, **kwargs):
     """
     Convert DART lidar output to LAS file (including waveforms if available in DART output)
 
@@ -346,21 +346,26 @@ def dart2las(simudir, las_file = None, type='bin', lasFormat=None, extra_bytes=T
     ----------
     simudir: str
         Simulation directory
-    las_file: str
+    las_file: str or list of str
         Path of a .las or .laz file. If None, it is <simulation>/output/LIDAR_IMAGE_FILE_{lasFormat}.las
+        If lasFormat is a list, a list of the same length is expected.
     type: str
         Either 'bin' to convert 'LIDAR_IMAGE_FILE.binary' or 'dp' to convert 'DetectedPoints.txt'.
-    lasFormat: int
+    lasFormat: int or list of int
         Point Data Record Format as specified in LAS 1.4 R15 (https://www.asprs.org/wp-content/uploads/2019/07/LAS_1_4_r15.pdf).
         If None, format 6 is taken for Detected Points simulation output, format 9 is taken for Waveform simulation output.
+        If a list, a LAS file is written for each format. With type='bin', waveforms are decoded and decomposed
+        only once for all the formats.
     extra_bytes: bool
         If True, variables other than intensity are included in LAS as extra-bytes (e.g. pulse width, amplitude, ...)
+    ncpu: int
+        Number of processes used for the gaussian decomposition of waveforms (type='bin').
     kwargs: dict
         Arguments passed to tools.DART2LAS.DART2LAS() if the waveforms were simulated (type='bin').
 
     Returns
     -------
-    str LAS file
+    str LAS file, or list of str if lasFormat is a list
 
     Notes
     -----
@@ -386,18 +391,25 @@ def dart2las(simudir, las_file = None, type='bin', lasFormat=None, extra_bytes=T
         raise ValueError('Simulation output directory not found: {}'.format(outputDpath))
 
 
+    multiple = isinstance(lasFormat, (list, tuple))
+
     if type == 'bin':
         InputFile = outputDpath / 'LIDAR_IMAGE_FILE.binary'
         if lasFormat is None:
             lasFormat = 9
+        lasFormats = list(lasFormat) if multiple else [lasFormat]
         if las_file is None:
-            las_file = outputDpath / f'LIDAR_IMAGE_FILE_{lasFormat}.las'
+            las_files = [outputDpath / f'LIDAR_IMAGE_FILE_{f}.las' for f in lasFormats]
+        else:
+            las_files = list(las_file) if multiple else [las_file]
+        if len(las_files) != len(lasFormats):
+            raise ValueError('las_file and lasFormat must have the same length.')
 
         if not InputFile.is_file():
             raise ValueError('LIDAR_IMAGE_FILE.binary not found in {}'.format(outputDpath))
 
         ### TODO: review after DART2LAS cleaning
-        d2l = DART2LAS.DART2LAS(las_format=lasFormat, extra_bytes=extra_bytes, **kwargs)
+        d2l = DART2LAS.DART2LAS(las_format=lasFormats[0], extra_bytes=extra_bytes, ncpu=ncpu, **kwargs)
         # obj.run()
         # d2l.lasVersion = 1.4  # a modifier selon la version
         # d2l.lasFormat = lasFormat  # a modifier selon le format
@@ -405,29 +417,37 @@ def dart2las(simudir, las_file = None, type='bin', lasFormat=None, extra_bytes=T
         # d2l.typeOut = 4  # have Gaussian max peak as intensity
         # d2l.extra_bytes = extra_bytes  # record Amplitude and Pulse width as given in RIEGL Whitepaper.
         # d2l.maxOutput = int(2 ** 16) - 1
-        dgain = []
-        doffset = []
-
-        print('Converting binary to LAS:\n {} --> {}'.format(InputFile, las_file))
-        digitizer_offset, digitizer_gain = d2l.readDARTBinaryFileAndConvert2LAS(InputFile, las_file)
+        print('Converting binary to LAS:\n {} --> {}'.format(InputFile, ', '.join(map(str, las_files))))
+        digitizer_offset, digitizer_gain = d2l.convert(InputFile, list(zip(lasFormats, las_files)))
         sys.stdout.flush()
-        dgain.append(digitizer_gain)
-        doffset.append(digitizer_offset)
-        # export gain values
-        df = pd.DataFrame(dict(gain=dgain, offset=doffset))
+        # export gain values, common to all outputs
+        df = pd.DataFrame(dict(gain=digitizer_gain, offset=digitizer_offset,
+                               las_file=las_files, lasFormat=lasFormats))
         df.to_csv(simudir / 'output' / 'waveform2las_gains.txt', sep='\t', index=False)
 
     elif type == 'dp':
         InputFile = outputDpath / 'DetectedPoints.txt'
         if lasFormat is None:
             lasFormat = 6
+        lasFormats = list(lasFormat) if multiple else [lasFormat]
         if las_file is None:
-            las_file = outputDpath / 'DetectedPoints.las'
-        print('{} --> {}'.format(InputFile, las_file))
-        DART2LAS.DP2LAS(InputFile, las_file, lasFormat=lasFormat)
+            if multiple:
+                las_files = [outputDpath / f'DetectedPoints_{f}.las' for f in lasFormats]
+            else:
+                las_files = [outputDpath / 'DetectedPoints.las']
+        else:
+            las_files = list(las_file) if multiple else [las_file]
+        if len(las_files) != len(lasFormats):
+            raise ValueError('las_file and lasFormat must have the same length.')
+        for f, l in zip(lasFormats, las_files):
+            print('{} --> {}'.format(InputFile, l))
+            DART2LAS.DP2LAS(InputFile, l, lasFormat=f)
         print('Done.')
 
-    return (las_file)
+    if multiple:
+        return las_files
+
+    return (las_files[0])
 
 
 class Run(object):
@@ -578,25 +598,29 @@ class Run(object):
         return stack_bands(simu_output_dir, output_dir=output_dir, driver=driver, rotate=rotate, phasefile=phasefile,
                            zenith=zenith, azimuth=azimuth, band_sub_dir=band_sub_dir, pattern=pattern)
 
-    def dart2las(self, las_file=None, lasFormat=None, extra_bytes=True, **kwargs):
+    def dart2las(self, las_file=None, lasFormat=None, extra_bytes=True, ncpu=1, **kwargs):
         """
         Convert DART lidar output to LAS file (including waveforms if available in DART output)
 
         Parameters
         ----------
-        las_file: str
+        las_file: str or list of str
             Path of a .las or .laz file. If None, it is <simulation>/output/LIDAR_IMAGE_FILE_{lasFormat}.las
-        lasFormat: int
+            If lasFormat is a list, a list of the same length is expected.
+        lasFormat: int or list of int
             Point Data Record Format as specified in LAS 1.4 R15 (https://www.asprs.org/wp-content/uploads/2019/07/LAS_1_4_r15.pdf).
             If None, format 6 is taken for Detected Points simulation output, format 9 is taken for Waveform simulation output.
+            If a list, a LAS file is written for each format, decoding and decomposing waveforms only once.
         extra_bytes: bool
             If True, variables other than intensity are included in LAS as extra-bytes (e.g. pulse width, amplitude, ...)
+        ncpu: int
+            Number of processes used for the gaussian decomposition of waveforms.
         kwargs: dict
             Arguments passed to tools.DART2LAS.DART2LAS() if the waveforms were simulated.
         
         Returns
         -------
-        str LAS file
+        str LAS file, or list of str if lasFormat is a list
 
         Notes
         -----
@@ -620,4 +644,4 @@ class Run(object):
         elif self.simu.core.phase.Phase.DartInputParameters.Lidar.PhotonCounting.pcDef==1:
             type='dp'
 
-        return dart2las(self.simu.simu_dir, las_file, type, lasFormat, extra_bytes, **kwargs)
\ No newline at end of file
+        return dart2las(self.simu.simu_dir, las_file, type, lasFormat, extra_bytes, ncpu, **kwargs)
\ No newline at end of file
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# PROGRAMMERS:
+#
+# Florian de Boissieu <fdeboiss@gmail.com>
+# https://gitlab.com/pytools4dart/pytools4dart
+#
+# COPYRIGHT:
+#
+# Copyright 2018-2019 Florian de Boissieu
+#
+# This file is part of the pytools4dart package.
+#
+# pytools4dart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+#
+# ===============================================================================
+"""
+Benchmark of lidar waveform processing on synthetic LIDAR_IMAGE_FILE.binary files,
+i.e. without DART installed.
+
+It times peak detection, gaussian decomposition and conversion to LAS at several
+numbers of pulses, and reports pulses/s. Run it with:
+
+    python -m pytools4dart.tests.benchmark_lidar --pulses 1000 10000 100000 --output benchmark.csv
+
+The file is not collected by pytest.
+"""
+
+import argparse
+import contextlib
+import io
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+from path import Path
+
+from pytools4dart.tools.DART2LAS import DART2LAS
+from pytools4dart.tools.DART2LAS.binary import write_synthetic_binary, read_pulses
+from pytools4dart.tools.DART2LAS.GaussianDecomposition import findZeroCrossingPeaks, findZeroCrossingPeaksBatch, \
+    gaussian_decomposition_batch
+
+
+def _timeit(fun, *args, **kwargs):
+    start = time.perf_counter()
+    fun(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def benchmark(nb_pulses, nb_bins=500, use_float=True, nb_echoes=3, las_format=9, ncpu=1,
+              wave_noise_threshold=2, tmpdir=None):
+    """
+    Benchmark lidar processing on a synthetic DART binary file.
+
+    Parameters
+    ----------
+    nb_pulses: int
+    nb_bins: int
+    use_float: bool
+    nb_echoes: int
+        See binary.write_synthetic_binary.
+    las_format: int
+        LAS format of conversion.
+    ncpu: int
+        Number of processes of conversion.
+    wave_noise_threshold: float
+        Threshold of peak detection and gaussian decomposition.
+    tmpdir: str
+        Directory of synthetic binary and LAS files. If None, a temporary directory is used.
+
+    Returns
+    -------
+    list of dict
+        Benchmark results: step, nb_pulses, time (s) and pulses_per_second.
+    """
+    if tmpdir is None:
+        tmpdir = tempfile.mkdtemp()
+    tmpdir = Path(tmpdir)
+    dartFileName = tmpdir / 'LIDAR_IMAGE_FILE.binary'
+    lasFileName = tmpdir / 'LIDAR_IMAGE_FILE.las'
+    write_synthetic_binary(dartFileName, nb_pulses, nb_bins, use_float, nb_echoes, seed=0)
+
+    # digitized waveforms, as in DART2LAS with automatic gain
+    waves = read_pulses(dartFileName)['waveform'].astype(float)
+    maxOutput = 2 ** 16
+    y = (waves * maxOutput / (2 * waves.max())).astype(int).astype(float)
+
+    timings = {}
+    timings['findZeroCrossingPeaks'] = _timeit(
+        lambda: [findZeroCrossingPeaks(yi, wave_noise_threshold, 3) for yi in y])
+    timings['findZeroCrossingPeaksBatch'] = _timeit(findZeroCrossingPeaksBatch, y, wave_noise_threshold, 3)
+    if DART2LAS.GaussianDecomposition is not None:
+        timings['GaussianDecomposition (gdecomp)'] = _timeit(
+            lambda: [DART2LAS.GaussianDecomposition(yi, float(wave_noise_threshold), 3) for yi in y])
+    timings['gaussian_decomposition_batch'] = _timeit(gaussian_decomposition_batch, y, wave_noise_threshold, 3)
+
+    d2l = DART2LAS.DART2LAS(las_format=las_format, wave_noise_threshold=wave_noise_threshold, ncpu=ncpu)
+    with contextlib.redirect_stdout(io.StringIO()):
+        timings['readDARTBinaryFileAndConvert2LAS'] = _timeit(
+            d2l.readDARTBinaryFileAndConvert2LAS, dartFileName, lasFileName)
+
+    return [dict(step=step, nb_pulses=nb_pulses, time=t, pulses_per_second=nb_pulses / t)
+            for step, t in timings.items()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of lidar waveform processing on synthetic DART files.')
+    parser.add_argument('--pulses', type=int, nargs='+', default=[1000, 10000], help='numbers of pulses')
+    parser.add_argument('--bins', type=int, default=500, help='number of bins of waveforms')
+    parser.add_argument('--double', action='store_true', help='waveforms in double precision')
+    parser.add_argument('--echoes', type=int, default=3, help='number of gaussian echoes per waveform')
+    parser.add_argument('--las-format', type=int, default=9, help='LAS format of conversion')
+    parser.add_argument('--ncpu', type=int, default=1, help='number of processes of conversion')
+    parser.add_argument('--output', help='CSV file to save results')
+    args = parser.parse_args()
+
+    results = []
+    for nb_pulses in args.pulses:
+        results += benchmark(nb_pulses, args.bins, not args.double, args.echoes, args.las_format, args.ncpu)
+    df = pd.DataFrame(results)
+    print(df.to_string(index=False))
+    if args.output is not None:
+        df.to_csv(args.output, index=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -56,6 +56,17 @@ def test_lidar_waveform():
     assert all(las_9.intensity == las_6.intensity)
     # assert all(np.floor(las_6.intensity/100) == np.array([327.,  32., 199.]))
 
+    # both formats in a single pass
+    las_files = simu.run.dart2las(lasFormat=[6, 9],
+                                  las_file=[las_6_file.replace('.las', '_multi.las'),
+                                            las_9_file.replace('.las', '_multi.las')])
+    las_6_multi = laspy.read(las_files[0])
+    las_9_multi = laspy.read(las_files[1])
+
+    assert all(las_6_multi.intensity == las_6.intensity)
+    assert all(las_9_multi.intensity == las_9.intensity)
+    assert all(las_9_multi.wavepacket_offset == las_9.wavepacket_offset)
+
     simu.simu_dir.rmtree()
 
 
@@ -167,3 +178,208 @@ def test_lidar_pointcloud():
     # assert all(las_9.intensity == np.array([65535,  6536, 39774]).astype(np.uint16))
 
 
+
+
+def test_peaks_batch():
+    from pytools4dart.tools.DART2LAS.GaussianDecomposition import findZeroCrossingPeaks, detect_peaks, \
+        findZeroCrossingPeaksBatch, detect_peaks_batch
+
+    rng = np.random.default_rng(0)
+    y = rng.uniform(0, 20, size=(200, 50))
+    y[::7] = 0
+
+    offsets, indices = findZeroCrossingPeaksBatch(y, 5, 3)
+    for i in range(len(y)):
+        assert np.array_equal(indices[offsets[i]:offsets[i+1]], findZeroCrossingPeaks(y[i], 5, 3))
+
+    offsets, indices = detect_peaks_batch(y, 0.3, 3)
+    for i in range(len(y)):
+        assert np.array_equal(indices[offsets[i]:offsets[i+1]], detect_peaks(y[i], 0.3, 3))
+
+
+def test_gaussian_decomposition_batch():
+    gdecomp = pytest.importorskip('gdecomp')
+    from pytools4dart.tools.DART2LAS.GaussianDecomposition import gaussian_decomposition_batch
+
+    rng = np.random.default_rng(0)
+    x = np.arange(100)
+    y = np.zeros((50, 100))
+    for i in range(len(y)):
+        for k in range(i % 4):
+            center, sigma, amplitude = rng.uniform(10, 90), rng.uniform(1, 3), rng.uniform(100, 1000)
+            y[i] += amplitude / (sigma * np.sqrt(2 * np.pi)) * np.exp(-(x - center) ** 2 / (2 * sigma ** 2))
+    y = y.astype(int).astype(float)
+
+    outs = gaussian_decomposition_batch(y, 2., 3)
+    for yi, out in zip(y, outs):
+        assert np.allclose(out, gdecomp.GaussianDecomposition(yi, 2., 3), rtol=1e-3, atol=1e-3)
+
+
+def test_dart2las_synthetic(tmp_path):
+    from pytools4dart.tools.DART2LAS import DART2LAS
+    from pytools4dart.tools.DART2LAS.binary import write_synthetic_binary
+
+    dartFileName = str(tmp_path / 'LIDAR_IMAGE_FILE.binary')
+    lasFileName = str(tmp_path / 'LIDAR_IMAGE_FILE.las')
+    write_synthetic_binary(dartFileName, nb_pulses=100, nb_bins=200, nb_echoes=3, seed=0)
+    progress = []
+    d2l = DART2LAS.DART2LAS(las_format=9, chunk_size=30, progress=progress.append)
+    d2l.readDARTBinaryFileAndConvert2LAS(dartFileName, lasFileName)
+
+    las = laspy.read(lasFileName)
+    assert len(las) == 100 * 3
+    assert np.all(las.number_of_returns == 3)
+    assert np.allclose(np.asarray(las.x) % 1, .5)
+
+    # progress is reported after each chunk of pulses
+    assert len(progress) == 4
+    assert [p['pulses'] for p in progress] == [30, 60, 90, 100]
+    assert all(p['nb_pulses'] == 100 for p in progress)
+    assert np.all(np.diff([p['points'] for p in progress]) > 0)
+    assert d2l.stats['pulses'] == 100
+    assert progress[-1]['points'] == d2l.stats['points'] == len(las)
+
+
+def test_dart2las_ncpu(tmp_path):
+    from pytools4dart.tools.DART2LAS import DART2LAS
+    from pytools4dart.tools.DART2LAS.binary import write_synthetic_binary
+
+    dartFileName = str(tmp_path / 'LIDAR_IMAGE_FILE.binary')
+    write_synthetic_binary(dartFileName, nb_pulses=100, nb_bins=200, nb_echoes=3, seed=0)
+
+    # parallel decomposition gives the same points and waveforms as serial one
+    outputs = []
+    for ncpu in [1, 2]:
+        lasFileName = str(tmp_path / 'ncpu{}.las'.format(ncpu))
+        DART2LAS.DART2LAS(las_format=9, chunk_size=30, ncpu=ncpu).readDARTBinaryFileAndConvert2LAS(dartFileName,
+                                                                                                    lasFileName)
+        outputs.append((laspy.read(lasFileName).points.array, Path(lasFileName[:-4] + '.wdp').bytes()))
+
+    assert len(outputs[0][0]) > 0
+    assert np.array_equal(outputs[1][0], outputs[0][0])
+    assert outputs[1][1] == outputs[0][1]
+
+
+def test_lidar_binary(tmp_path):
+    from pytools4dart.tools.DART2LAS.binary import write_synthetic_binary, read_pulses, LidarBinary, export_pulses
+
+    dartFileName = str(tmp_path / 'LIDAR_IMAGE_FILE.binary')
+    write_synthetic_binary(dartFileName, nb_pulses=100, nb_bins=50, seed=0)
+    pulses = read_pulses(dartFileName)
+
+    # subset written to a new binary
+    lb = LidarBinary(dartFileName)
+    idx = lb.select(2, 3, 5, 7)
+    assert len(idx) == 3 * 4
+    subsetFileName = str(tmp_path / 'subset.binary')
+    lb.write(subsetFileName, idx, chunk_size=7)
+    lb.close()
+    subset = read_pulses(subsetFileName)
+    assert np.array_equal(subset, pulses[idx])
+    assert LidarBinary(subsetFileName).header['nb_pulses'] == 12
+
+    # exports
+    store = export_pulses(dartFileName, tmp_path / 'pulses', chunk_size=30)
+    for field in pulses.dtype.names:
+        assert np.array_equal(np.load(store / (field + '.npy')), pulses[field])
+
+    zarr = pytest.importorskip('zarr')
+    store = zarr.open_group(str(export_pulses(dartFileName, tmp_path / 'pulses.zarr', chunk_size=30)), mode='r')
+    for field in pulses.dtype.names:
+        assert np.array_equal(store[field][:], pulses[field])
+
+    h5py = pytest.importorskip('h5py')
+    with h5py.File(export_pulses(dartFileName, tmp_path / 'pulses.h5', chunk_size=30, compression=True), 'r') as store:
+        for field in pulses.dtype.names:
+            assert np.array_equal(store[field][:], pulses[field])
+
+
+@pytest.mark.parametrize('engine', ['pyarrow', 'pandas'])
+def test_DP2LAS(tmp_path, monkeypatch, engine):
+    from pytools4dart.tools.DART2LAS import DART2LAS
+
+    if engine == 'pyarrow':
+        pytest.importorskip('pyarrow')
+    else:
+        monkeypatch.setattr(DART2LAS, 'pacsv', None)
+
+    # DetectedPoints.txt with columns not converted and a trailing tab
+    points = np.array([[10.5, 20.25, 3.125, 1, 2],
+                       [10.5, 20.25, 1.0, 2, 2],
+                       [-1.5, 0.0005, 0.001, 1, 1],
+                       [7.0, 8.0, 9.0, 1, 9],
+                       [7.0, 8.0, 8.0, 8, 9]])
+    inputFile = str(tmp_path / 'DetectedPoints.txt')
+    with open(inputFile, 'w') as f:
+        f.write('PulseIndx\tX(m)\tY(m)\tZ(m)\tIntensity\tReturnIndx\tNumberReturns\n')
+        for n, (x, y, z, r, nr) in enumerate(points):
+            f.write('{}\t{}\t{}\t{}\t0.5\t{:d}\t{:d}\t\n'.format(n, x, y, z, int(r), int(nr)))
+
+    # LAS format 1: returns above 7 are removed and number of returns is limited to 7
+    outputFile = str(tmp_path / 'DetectedPoints.las')
+    DART2LAS.DP2LAS(inputFile, outputFile, lasFormat=1, chunk_size=2)
+    las = laspy.read(outputFile)
+    expected = points[:4]
+    assert np.allclose(las.x, expected[:, 0], atol=.0005)
+    assert np.allclose(las.y, expected[:, 1], atol=.0005)
+    assert np.allclose(las.z, expected[:, 2], atol=.0005)
+    assert np.array_equal(las.return_number, expected[:, 3])
+    assert np.array_equal(las.number_of_returns, [2, 2, 1, 7])
+
+    DART2LAS.DP2LAS(inputFile, outputFile, lasFormat=6)
+    las = laspy.read(outputFile)
+    assert np.allclose(las.z, points[:, 2], atol=.0005)
+    assert np.array_equal(las.return_number, points[:, 3])
+    assert np.array_equal(las.number_of_returns, points[:, 4])
+
+
+def test_decomposition_cache(tmp_path, monkeypatch):
+    from pytools4dart.tools.DART2LAS import DART2LAS
+    from pytools4dart.tools.DART2LAS.binary import write_synthetic_binary
+
+    dartFileName = str(tmp_path / 'LIDAR_IMAGE_FILE.binary')
+    write_synthetic_binary(dartFileName, nb_pulses=100, nb_bins=200, nb_echoes=3, seed=0)
+
+    # count the pulses decomposed
+    decompose_waveforms = DART2LAS.decompose_waveforms
+    decomposed = []
+    def counting_decompose(waves, *args):
+        decomposed.append(len(waves))
+        return decompose_waveforms(waves, *args)
+    monkeypatch.setattr(DART2LAS, 'decompose_waveforms', counting_decompose)
+
+    def convert(lasFileName, **kwargs):
+        decomposed.clear()
+        d2l = DART2LAS.DART2LAS(las_format=6, chunk_size=30, decomposition_cache=True, **kwargs)
+        d2l.readDARTBinaryFileAndConvert2LAS(dartFileName, str(tmp_path / lasFileName))
+        return laspy.read(str(tmp_path / lasFileName)).points.array, sum(decomposed)
+
+    points, nb_decomposed = convert('first.las')
+    assert nb_decomposed == 100
+    cached_points, nb_decomposed = convert('second.las')
+    assert nb_decomposed == 0
+    assert np.array_equal(cached_points, points)
+
+    # threshold and gain are part of the cache key
+    assert convert('threshold.las', wave_noise_threshold=3)[1] == 100
+    assert convert('gain.las', receiver_gain=100.)[1] == 100
+    assert convert('gain_cached.las', receiver_gain=100.)[1] == 0
+
+    # decomposition backend is part of the cache key
+    from pytools4dart.tools.DART2LAS.GaussianDecomposition import gaussian_decomposition_batch
+    if DART2LAS.GaussianDecomposition is None:
+        other_backend = lambda y, threshold, n: gaussian_decomposition_batch(y[np.newaxis], threshold, n)[0]
+    else:
+        other_backend = None
+    with monkeypatch.context() as m:
+        m.setattr(DART2LAS, 'GaussianDecomposition', other_backend)
+        assert convert('backend.las', receiver_gain=100.)[1] == 100
+        assert convert('backend_cached.las', receiver_gain=100.)[1] == 0
+    assert convert('gain_cached.las', receiver_gain=100.)[1] == 100
+
+    # interrupted conversion is resumed
+    cacheDir = Path(dartFileName + '.decomposition')
+    (cacheDir / 'pulses.txt').write_text('45')
+    resumed_points, nb_decomposed = convert('resumed.las', receiver_gain=100.)
+    assert nb_decomposed == 55
+    assert np.array_equal(resumed_points, convert('gain_cached.las', receiver_gain=100.)[0])
@@ -0,0 +1,137 @@
+import pytest
+import pytools4dart as ptd
+import numpy as np
+import pandas as pd
+import shutil
+from path import Path
+
+voxfile = Path(ptd.__file__).parent / 'data' / 'forest.vox'
+
+
+def test_from_vox_compact_cache(tmp_path):
+    pytest.importorskip('pyarrow')
+    vox = ptd.voxreader.voxel.from_vox(voxfile)
+
+    # pyarrow engine with compact types and column selection
+    compact = ptd.voxreader.voxel.from_vox(voxfile, columns=['pad'], compact=True, engine='pyarrow')
+    assert list(compact.data.columns) == ['i', 'j', 'k', 'pad']
+    assert compact.data['i'].dtype == np.int16 and compact.data['pad'].dtype == np.float32
+    assert np.allclose(compact.data, vox.data.loc[:, ['i', 'j', 'k', 'pad']], equal_nan=True)
+
+    # sidecar file written at first load and read at next
+    tmpfile = Path(str(tmp_path)) / 'forest.vox'
+    shutil.copy(voxfile, tmpfile)
+    for cache in ['parquet', 'feather']:
+        assert ptd.voxreader.voxel.from_vox(tmpfile, cache=cache).data.equals(vox.data)
+        assert (tmpfile + '.' + cache).exists()
+        assert ptd.voxreader.voxel.from_vox(tmpfile, cache=cache).data.equals(vox.data)
+
+
+def test_from_vox_sparse():
+    vox = ptd.voxreader.voxel.from_vox(voxfile)
+    sparse = ptd.voxreader.voxel.from_vox(voxfile, sparse=True, chunk_size=1000)
+    occupied = vox.data.loc[(vox.data.pad != 0) & pd.notna(vox.data.pad)].reset_index(drop=True)
+    assert sparse.data.equals(occupied)
+    assert sparse.header['split'].tolist() == vox.header['split'].tolist()
+    assert sparse.to_plots().equals(vox.to_plots())
+
+    # pad is used to drop empty voxels but not returned
+    sparse = ptd.voxreader.voxel.from_vox(voxfile, columns=['angleMean'], sparse=True, chunk_size=1000)
+    assert list(sparse.data.columns) == ['i', 'j', 'k', 'angleMean']
+    assert sparse.data.equals(occupied.loc[:, ['i', 'j', 'k', 'angleMean']])
+
+
+def test_from_vox_sparse_without_pad(tmp_path):
+    # .vox file without column PadBVTotal
+    lines = [l.replace(' PadBVTotal ', ' pad ') for l in voxfile.lines(retain=False)]
+    nopad_file = Path(tmp_path) / 'nopad.vox'
+    nopad_file.write_lines(lines)
+    with pytest.raises(ValueError, match='PadBVTotal'):
+        ptd.voxreader.voxel.from_vox(nopad_file, sparse=True)
+    with pytest.raises(ValueError, match='PadBVTotal'):
+        ptd.voxreader.voxel.tiles_to_plots(nopad_file, tmp_path, tile_size=10)
+
+
+def test_intersect_raster_window():
+    raster_file = voxfile.parent / 'Can_Cab_Car_CBrown.tif'
+    vox = ptd.voxreader.voxel.from_vox(voxfile)
+    masked = vox.intersect(raster_file, columns=['Can', 'Cab', 'Car', 'CBrown'])
+    windowed = vox.intersect(raster_file, columns=['Can', 'Cab', 'Car', 'CBrown'], window=True)
+    assert windowed.equals(masked)
+    assert masked.Cab.notna().all()
+
+
+def test_intersect_polygons_non_square():
+    import geopandas as gpd
+    from shapely.geometry import Point
+
+    vox = ptd.voxreader.voxel.from_data(i=[0, 29], j=[0, 9], k=[0, 0], pad=1)
+    polygons = gpd.GeoDataFrame({'name': ['a', 'b']}, geometry=[Point(2, 2).buffer(1.5), Point(29.5, 9.5).buffer(.4)])
+    data = vox.intersect(polygons)
+    assert data.name.tolist() == ['a', 'b']
+    assert np.isclose(data.intersected_area[1], polygons.geometry[1].area)
+
+
+def test_affine_transform_lazy():
+    from shapely.affinity import affine_transform
+    vox = ptd.voxreader.voxel.from_vox(voxfile)
+    grid = vox.grid.copy()
+    transforms = [(0.6, 0.8, -0.8, 0.6, 100., -50.), (1, 0, 0, 1, -10, -20)]
+    for t in transforms:
+        vox.affine_transform(t, inplace=True)
+    assert vox.header['transforms'] == transforms
+    for t in transforms:
+        grid.geometry = [affine_transform(g, t) for g in grid.geometry]
+    assert vox.grid.geom_equals_exact(grid.geometry, tolerance=1e-9).all()
+    plots = vox.to_plots()
+    corners = [c for c in plots.columns if c.startswith('PT_')]
+    assert np.allclose(plots[corners], vox.to_plots(from_grid=True)[corners])
+
+
+def test_cube():
+    vox = ptd.voxreader.voxel.from_vox(voxfile, sparse=True)
+    cube = vox.to_cube(['pad', 'angleMean'], fill_value=np.nan)
+    assert cube['pad'].shape == (56, 20, 20)
+    assert np.isclose(np.nansum(cube['pad']), vox.data.pad.sum())
+
+    vox2 = ptd.voxreader.voxel.from_cube(cube, vox.header['min_corner'], vox.header['res'], sparse=True)
+    assert vox2.data.equals(vox.data.loc[:, ['i', 'j', 'k', 'pad', 'angleMean']])
+    assert vox2.header['split'] == [20, 20, 56]
+
+
+def test_to_raster_aggregate(tmp_path):
+    import rasterio
+
+    vox = ptd.voxreader.voxel.from_vox(voxfile, sparse=True)
+    raster_file = str(tmp_path / 'pai.tif')
+    with rasterio.open(vox.to_raster(raster_file, aggregate_fun=lambda x: x['pad'].sum())) as r:
+        expected = r.read()
+    with rasterio.open(vox.to_raster(raster_file, aggregate_fun='sum')) as r:
+        pai = r.read()
+    assert pai.shape == (1, 20, 20)
+    assert np.allclose(pai, expected, equal_nan=True)
+
+    # column of voxels with pad equal to 0 has no height of maximum pad
+    vox = ptd.voxreader.voxel.from_data(i=[0, 0, 1, 1], j=[0, 0, 0, 0], k=[0, 1, 0, 1], pad=[0., 0., 1., 2.])
+    with rasterio.open(vox.to_raster(raster_file, aggregate_fun='hmax')) as r:
+        hmax = r.read()
+    assert np.isnan(hmax[0, 0, 0])
+    assert hmax[0, 0, 1] == 1.5
+
+
+def test_tiles_to_plots(tmp_path):
+    transforms = [(0.6, 0.8, -0.8, 0.6, 10., 5.)]
+    vox = ptd.voxreader.voxel.from_vox(voxfile)
+    for t in transforms:
+        vox.affine_transform(t, inplace=True)
+    plots = vox.to_plots()
+
+    tiles = ptd.voxreader.voxel.tiles_to_plots(voxfile, str(tmp_path), tile_size=7, transforms=transforms,
+                                               chunk_size=3000, ncpu=2)
+    assert len(tiles) == 9
+    tiled = pd.concat([pd.read_csv(f, sep='\t', comment='*', float_precision='round_trip')
+                       for f in tiles.plots_file], ignore_index=True)
+    key = ['PT_1_X', 'PT_1_Y', 'PLT_BTM_HEI']
+    tiled = tiled.sort_values(key).reset_index(drop=True)
+    plots = plots.sort_values(key).reset_index(drop=True)
+    assert np.array_equal(tiled.values, plots.values)
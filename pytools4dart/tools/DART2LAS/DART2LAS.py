@@ -7,37 +7,242 @@ Created on Aug 25, 2017
 @author: Grégoire Couderc : contribution to format specification.
 '''
 
+import os
 import sys
+import time
+import logging
 import warnings
 import struct
 import math
 import argparse
+from multiprocessing import Pool
 import laspy
 import numpy as np
 from .GaussianDecomposition import *
-from gdecomp import GaussianDecomposition
+from .binary import hearder_length, waveform_parameter_length, hearder_format, waveform_parameter_format, \
+    read_header, read_pulses, iter_pulse_chunks, waveform_max, content_hash
+try:
+    from gdecomp import GaussianDecomposition
+except ImportError:
+    warnings.warn("""
+Module 'gdecomp' not found, falling back to numpy gaussian decomposition of waveforms.
+Package 'gdecomp' can be installed with "pip install gdecomp".""")
+    GaussianDecomposition = None
+try:
+    import pyarrow.csv as pacsv
+except ImportError:  # pandas is used to read DetectedPoints.txt
+    pacsv = None
+
+logger = logging.getLogger(__name__)
 
 speedOfLightPerNS=0.299792458
 
-hearder_length=90            # 50+12+28
-waveform_parameter_length=104 #
-
-hearder_format="=50s2I4?2d3I"
-waveform_parameter_format="=11d4I"
-# pulse_info[0] (double): Look angle (in rad) (from -pi/2 (left) to pi/2 (right))
-# pulse_info[[1,2]] (double): Incident angles: theta, phi (in rad)
-# pulse_info[[3, 4, 5]] (double): Incident unit distance: x, y, z (in meter)
-# pulse_info[[6,7,8]] (double): Platform position: x, y, z (in meter)
-# pulse_info[9] (double): Beginning time of the convolved waveform
-# pulse_info[10] (double): Beginning time of the non-convolved waveform
-# pulse_info[11] (uint): Number of bins from sensor to center of FOV
-# pulse_info[[12, 13, 14]] (uint): not documented in DART User Manual...
-# pulse_info[14] (unint): seems to be the pulse ID, cf code below.
+# hearder_format, waveform_parameter_format and pulse record structure
+# are defined in module binary, see binary.pulse_parameter_fields for details.
 to8bit_format="=b"
 
 evlr_wave_header_length = 60
 evlr_wave_format = "<1H16s1HQ32s"
 
+ANGLE_INC = 0.006 # angle increment for LAS 1.4 format 6-10
+
+waveform_formats = [4, 5, 9, 10] # LAS point formats including waveforms
+
+
+def decompose_waveforms(waves, receiveWaveGain, maxOutput, waveNoiseThreshold):
+    """
+    Gaussian decomposition of digitized waveforms.
+
+    Parameters
+    ----------
+    waves: numpy.ndarray
+        Waveforms of shape (nbPulses, nbBinsConvolved)
+    receiveWaveGain: float
+        Gain applied to waveforms before digitization.
+    maxOutput: int
+        Maximum output of the digitizer.
+    waveNoiseThreshold: float
+        Threshold underwhich peak is not considered as an echo.
+
+    Returns
+    -------
+    list
+        For each pulse, the array of the gaussian parameters (amplitude, center, sigma) of shape (n, 3),
+        or None if the waveform is empty.
+    """
+    y_decomp = (waves * receiveWaveGain).astype(int)
+    y_decomp[y_decomp > maxOutput] = maxOutput # should never happen
+    nonempty = np.flatnonzero((waves > 0).any(axis=1) & (y_decomp > 0).any(axis=1))
+
+    outs = [None] * len(waves)
+    if GaussianDecomposition is None:
+        # numpy fallback, decomposing all the waveforms at once
+        decompositions = gaussian_decomposition_batch(y_decomp[nonempty].astype(float),
+                                                      float(waveNoiseThreshold), 3)
+    else:
+        decompositions = [GaussianDecomposition(y.astype(float), float(waveNoiseThreshold), 3)
+                          for y in y_decomp[nonempty]]
+    for i, out in zip(nonempty, decompositions):
+        outs[i] = out
+    return outs
+
+
+def pack_decompositions(start, outs):
+    """
+    Stack the gaussian decompositions of consecutive pulses.
+
+    Parameters
+    ----------
+    start: int
+        Index of the first pulse.
+    outs: list
+        Gaussian decompositions as returned by decompose_waveforms.
+
+    Returns
+    -------
+    (numpy.ndarray, numpy.ndarray)
+        Pulse index of each gaussian, and gaussian parameters (amplitude, center, sigma) of shape (n, 3).
+    """
+    pulse = [np.full(len(out) // 3, start + i, dtype=np.int64) for i, out in enumerate(outs)
+             if out is not None and len(out) > 0]
+    gaussian = [np.reshape(out, (-1, 3)) for out in outs if out is not None and len(out) > 0]
+    if len(pulse) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 3))
+    return np.concatenate(pulse), np.concatenate(gaussian)
+
+
+def unpack_decompositions(pulse, gaussian, start, nbPulses):
+    """
+    Gaussian decompositions of pulses [start, start + nbPulses) from stacked decompositions.
+
+    Parameters
+    ----------
+    pulse: numpy.ndarray
+        Sorted pulse index of each gaussian, see pack_decompositions.
+    gaussian: numpy.ndarray
+        Gaussian parameters, see pack_decompositions.
+    start: int
+        Index of the first pulse.
+    nbPulses: int
+        Number of pulses.
+
+    Returns
+    -------
+    list
+        Flat array of gaussian parameters for each pulse, empty if no gaussian was found.
+    """
+    lo, hi = np.searchsorted(pulse, [start, start + nbPulses])
+    counts = np.bincount(pulse[lo:hi] - start, minlength=nbPulses)
+    return [g.ravel() for g in np.split(gaussian[lo:hi], np.cumsum(counts)[:-1])]
+
+
+class DecompositionCache(object):
+    """
+    Gaussian decompositions of the pulses of a DART binary file, appended to disk chunk by chunk.
+
+    The cache is a directory with files:
+        - key.txt: key of the decompositions, e.g. content hash of the binary file, threshold and gain
+        - pulse.bin: pulse index of each gaussian (int64), see pack_decompositions
+        - gaussian.bin: gaussian parameters (amplitude, center, sigma) in float64
+        - pulses.txt: number of pulses decomposed, updated after each chunk
+
+    A cache with a different key is reset. An interrupted conversion leaves the decompositions
+    of the chunks already done, the next conversion reads them and decomposes the other pulses only.
+
+    Parameters
+    ----------
+    cacheDir: str
+        Path of the cache directory.
+    key: str
+        Key of the decompositions.
+    """
+    def __init__(self, cacheDir, key):
+        self.cacheDir = cacheDir
+        self.key = key
+        os.makedirs(cacheDir, exist_ok=True)
+        keyFile = os.path.join(cacheDir, 'key.txt')
+        storedKey = None
+        if os.path.isfile(keyFile):
+            with open(keyFile) as f:
+                storedKey = f.read()
+
+        self.nbPulses = 0
+        if storedKey == key and os.path.isfile(self._file('pulses.txt')):
+            with open(self._file('pulses.txt')) as f:
+                self.nbPulses = int(f.read())
+        else:
+            for name in ['pulse.bin', 'gaussian.bin', 'pulses.txt']:
+                if os.path.isfile(self._file(name)):
+                    os.remove(self._file(name))
+            with open(keyFile, 'w') as f:
+                f.write(key)
+
+        self._load()
+        # gaussians of pulses written after the last update of pulses.txt, e.g. interrupted conversion
+        nbGaussians = int(np.searchsorted(self.pulse, self.nbPulses))
+        if nbGaussians < len(self.pulse):
+            del self.pulse, self.gaussian
+            os.truncate(self._file('pulse.bin'), nbGaussians * 8)
+            os.truncate(self._file('gaussian.bin'), nbGaussians * 3 * 8)
+            self._load()
+
+    def _file(self, name):
+        return os.path.join(self.cacheDir, name)
+
+    def _load(self):
+        """
+        Memory map the decompositions on disk.
+        """
+        if os.path.isfile(self._file('pulse.bin')) and os.path.getsize(self._file('pulse.bin')) > 0:
+            self.pulse = np.memmap(self._file('pulse.bin'), dtype=np.int64, mode='r')
+            self.gaussian = np.memmap(self._file('gaussian.bin'), dtype=np.float64, mode='r').reshape((-1, 3))
+        else:
+            self.pulse = np.zeros(0, dtype=np.int64)
+            self.gaussian = np.zeros((0, 3))
+
+    def get(self, start, nbPulses):
+        """
+        Gaussian decompositions of pulses [start, start + nbPulses), see unpack_decompositions.
+        Pulses must have been decomposed, i.e. start + nbPulses <= self.nbPulses.
+        """
+        return unpack_decompositions(self.pulse, self.gaussian, start, nbPulses)
+
+    def append(self, start, decompositions):
+        """
+        Append the gaussian decompositions of pulses [start, start + len(decompositions)) to disk.
+        start must be the number of pulses already decomposed.
+        """
+        if start != self.nbPulses:
+            raise ValueError('Decompositions must be appended in pulse order.')
+        pulse, gaussian = pack_decompositions(start, decompositions)
+        with open(self._file('pulse.bin'), 'ab') as f:
+            pulse.astype(np.int64).tofile(f)
+        with open(self._file('gaussian.bin'), 'ab') as f:
+            gaussian.astype(np.float64).tofile(f)
+        self.nbPulses = start + len(decompositions)
+        tmpFile = self._file('pulses.txt.tmp')
+        with open(tmpFile, 'w') as f:
+            f.write(str(self.nbPulses))
+        os.replace(tmpFile, self._file('pulses.txt'))
+
+    def close(self):
+        """
+        Release the memory maps.
+        """
+        self.pulse = self.gaussian = None
+
+
+def _decompose_pulses(dartFileName, start, stop, receiveWaveGain, maxOutput, waveNoiseThreshold):
+    """
+    Gaussian decomposition of the waveforms of pulses [start, stop) of a DART binary file.
+    Used by the worker processes of DART2LAS, see decompose_waveforms.
+    """
+    pulses = read_pulses(dartFileName)
+    waves = pulses['waveform'][start:stop].astype(float)
+    del pulses
+    return decompose_waveforms(waves, receiveWaveGain, maxOutput, waveNoiseThreshold)
+
+
 class DART2LAS(object):
     '''
     Class to convert DART full-waveform lidar simulation binary files to LAS.
@@ -48,6 +253,8 @@ class DART2LAS(object):
                  keep_waveform = False, las_format = None, las_version = 1.4,
                  scale = 0.001, 
                  minimum_intensity = 1, extra_bytes = True,
+                 chunk_size = 10000, ncpu = 1, decomposition_cache = False,
+                 progress = None,
                  ):
         """Class to convert DART full-waveform lidar simulation binary files to LAS.
         It support all LAS 1.4 formats including waveforms, point clouds and
@@ -79,6 +286,24 @@ class DART2LAS(object):
             Used to compute amplitude in dB, by default 1.
         extra_bytes : bool, optional
             Should extra_bytes variable be included (e.g. Amplitude and Pulse Width), by default True.
+        chunk_size : int, optional
+            Number of pulses decoded and written at once, by default 10000.
+            Peak memory of the conversion is bounded by the chunk size.
+        ncpu : int, optional
+            Number of processes used for the Gaussian decomposition of waveforms, by default 1.
+            Each chunk of pulses is split in ncpu shards decomposed in parallel,
+            the output is the same as with a single process.
+        decomposition_cache : bool, optional
+            Should the gaussian decomposition of waveforms be cached, by default False.
+            If True, the decomposition is saved chunk by chunk in directory '<dartFileName>.decomposition'
+            and reused by later conversions of the same file (same content, wave_noise_threshold, gain
+            and decomposition backend, i.e. gdecomp or numpy fallback),
+            e.g. to change the LAS format, the scale, the extra bytes or the type of intensity.
+            Point coordinates are recomputed from the pulses of dartFileName.
+            An interrupted conversion is resumed from the last chunk decomposed, see DecompositionCache.
+        progress : callable, optional
+            Function called with the conversion statistics (dict) after each chunk of pulses, by default None.
+            See Notes for the statistics reported.
         
         Notes
         -----
@@ -99,6 +324,16 @@ class DART2LAS(object):
         We used 2*waveMax in order to keep a margin for the decomposed gaussian peak intensity that is usually
         larger than the maximum intensity value of the waveform.
         It avoids the saturation of the extracted return intensity in LAS format.
+
+        Statistics of the last conversion are available in attribute `stats` (dict), with keys:
+        - nb_pulses: total number of pulses of the DART file
+        - pulses, points, bytes_read: number of pulses converted, of returns found and of bytes read so far
+        - time_decode, time_decomposition, time_points, time_write: time (s) spent in decoding pulses,
+          in gaussian decomposition, in computing points and in writing LAS and waveform files
+        - time_total: elapsed time (s) since the beginning of the conversion
+        - pulses_per_second, points_per_second: conversion throughput
+        They are also logged at DEBUG level for each chunk (logger 'pytools4dart.tools.DART2LAS.DART2LAS'),
+        and at INFO level at the end of the conversion.
         """
         self.ifFixedGain = (receiver_gain is not None)
         self.typeOut = type_out
@@ -134,7 +369,12 @@ class DART2LAS(object):
         self.byteOption = self.nbBytePerWaveAmplitude > 1 # False for 8 bits to represent waveform amplitude, True for 16 bits to represent waveform amplitude
 
         self.waveformAmplitudeFomat = 'H'
-        
+        self.chunk_size = chunk_size
+        self.ncpu = ncpu
+        self.decomposition_cache = decomposition_cache
+        self.progress = progress
+        self.stats = None
+
     def readSolarNoiseFile(self):
         print('reading solar noise file: ',self.snFile)
         with open(self.snFile,'r') as f:
@@ -166,27 +406,58 @@ class DART2LAS(object):
         digitizer_offset and digitizer_gain
         """
 
-        if 'maxOutput' in self.__dict__:
-            warnings.warn('Since pytools4dart 1.1.19, maxOutput is computed from nbBytePerWaveAmplitude')
-
         if self.lasFormat is None:  # set default format if empty
             if self.ifWriteWaveform:
                 self.lasFormat = 4
             else:
                 self.lasFormat = 1
         else:  # check format if not empty
-            self.ifWriteWaveform = (self.lasFormat in [4, 5, 9, 10])
+            self.ifWriteWaveform = (self.lasFormat in waveform_formats)
+
+        return self.convert(dartFileName, [(self.lasFormat, lasFileName)])
+
+    def convert(self, dartFileName, outputs):
+        """
+        Convert a DART binary file to one or several LAS files.
+        Waveforms are decoded and decomposed once for all the outputs.
+
+        Parameters
+        ----------
+        dartFileName: str
+        outputs: list of tuple
+            (lasFormat, lasFileName) of each LAS file to write.
+            For formats including waveforms (4, 5, 9, 10), waveforms are written
+            in the corresponding .wdp file, e.g. 'file.wdp' for 'file.las'.
+
+        Returns
+        -------
+        (float, float)
+        digitizer_offset and digitizer_gain, common to all outputs
+
+        Examples
+        --------
+        >>> from pytools4dart.tools.DART2LAS.DART2LAS import DART2LAS
+        >>> d2l = DART2LAS()
+        >>> d2l.convert('LIDAR_IMAGE_FILE.binary', [(6, 'LIDAR_IMAGE_FILE_6.las'), (9, 'LIDAR_IMAGE_FILE_9.las')]) # doctest: +SKIP
+        """
+
+        if 'maxOutput' in self.__dict__:
+            warnings.warn('Since pytools4dart 1.1.19, maxOutput is computed from nbBytePerWaveAmplitude')
 
         if self.lasVersion < 1.3:
             raise ValueError("LAS version not available.")
-            
-        if self.lasFormat > 5 and self.lasVersion == 1.3:
-            raise ValueError("LAS format > 5 not available for LAS version < 1.4")
-        
+
+        for lasFormat, lasFileName in outputs:
+            if lasFormat > 5 and self.lasVersion == 1.3:
+                raise ValueError("LAS format > 5 not available for LAS version < 1.4")
+
         self.maxOutput = int(2**(self.nbBytePerWaveAmplitude*8))-1 # UINT16 used by RIEGL sensors
 
+        # waveform variables are computed if any of the outputs needs them
+        ifWriteWaveform = any([lasFormat in waveform_formats for lasFormat, lasFileName in outputs])
 
-        print("LAS format: " + str(self.lasFormat))
+        for lasFormat, lasFileName in outputs:
+            print("LAS format: " + str(lasFormat))
 
         # if self.ifSolarNoise:
         #     self.readSolarNoiseFile()
@@ -195,65 +466,31 @@ class DART2LAS(object):
 
 
         # DART Header
-        dartfile = open(dartFileName, "rb")   ###DART file
-        
-        try:
-            hearder_record = dartfile.read(hearder_length)
-        except:
-            tb = sys.exc_info()[2]
-            print("Reading failed on input DART file " + dartFileName + "\n")
-            sys.exit(1)
-        header_data=struct.unpack(hearder_format,hearder_record)
+        header = read_header(dartFileName)
         print("Input Data Information:")
-        print("  Version: ", header_data[0][0:42])    
-        #Parameters about the locations of the waveform record
-        ifFormatFloat=header_data[3]
-        ifExistNonConv=header_data[4]
-        ifExistFirstOrder=header_data[5]
-        ifExistStats=header_data[6]
-
-        nbBinsConvolved=header_data[9]
-        nbBinsNonConvolved=header_data[10]
-
-        #Calculate the offset of waveforms between pulses
-        posOffsetPerPulse=0
-        nbBytes=8
-        waveIterFormat="=%dd"
-        if ifFormatFloat:
-            nbBytes=4
-            waveIterFormat="=%df"
-
-        if ifExistStats:
-            posOffsetPerPulse+=9+41*nbBytes-1
-        if ifExistNonConv:
-            if ifExistFirstOrder:
-                posOffsetPerPulse+=nbBytes*(2*nbBinsNonConvolved+nbBinsConvolved)
-            else:
-                posOffsetPerPulse+=nbBytes*nbBinsNonConvolved
-        else:
-            if ifExistFirstOrder:
-                posOffsetPerPulse+=nbBytes*nbBinsConvolved
-
-        convolved_Length=nbBytes*nbBinsConvolved  #The length of convolved waveform data in bytes
+        print("  Version: ", header['version'][0:42])
+        nbBinsConvolved=header['nb_bins_convolved']
 
         #Pulse Global Parameters:
-        timeStep_in_nano_second=header_data[7]
+        timeStep_in_nano_second=header['time_step']
         timeStep_in_pico_second=timeStep_in_nano_second * 1000.0
-        distStep=header_data[8]
+        distStep=header['dist_step']
         print("timeStep_in_nano_second", timeStep_in_nano_second)
-        nbPulses=header_data[11]
+        nbPulses=header['nb_pulses']
         print('Total number of pulses: ',nbPulses)
-        
-        
+
+        # pulses records are decoded by chunks from a memory map of the file
+        pulses = read_pulses(dartFileName, header)
 
             
-        if self.ifWriteWaveform:
+        waveformfiles = {}
+        off_waveformfile = waveformPacketSize = None
+        if ifWriteWaveform:
             #Waveform Output file Header
             if not self.byteOption: # For 8 bit representative
                 self.nbBytePerWaveAmplitude = 1 
                 self.waveformAmplitudeFomat = 'B'
-            
-            waveformfile = open(lasFileName[:-4]+'.wdp', 'wb')
+
             #format definition
             reserve_evlr_wave = 0
             user_id_evlr_wave = b'LASF_Spec       '
@@ -264,290 +501,247 @@ class DART2LAS(object):
             if not len(header_packed) == evlr_wave_header_length:
                 raise ValueError('waveform file header length not satisifed!!!')
 
-            waveformfile.write(header_packed)
-            off_waveformfile = waveformfile.tell()
+            for lasFormat, lasFileName in outputs:
+                if lasFormat in waveform_formats and lasFileName not in waveformfiles:
+                    waveformfile = open(lasFileName[:-4]+'.wdp', 'wb')
+                    waveformfile.write(header_packed)
+                    waveformfiles[lasFileName] = waveformfile
+            off_waveformfile = evlr_wave_header_length
             print('off_waveformfile', off_waveformfile)
+            # waveforms are written contiguously, thus their offset is computed from the number already written
+            waveformPacketSize = nbBinsConvolved * self.nbBytePerWaveAmplitude
 
         #read and convert parameters:
 
-        tmp = dartfile.tell()
-
 #         outPulses = list()
         feedback = int(nbPulses/10.0)
         countPulses = 0
-        pulsesInBuffer = 0
 
         tmpIndicatorPast = 0
 
-        # points vectors
-        x_v=[]
-        y_v=[]
-        z_v=[]
-        intensity_v=[]
-        return_num_v=[]
-        num_returns_v=[]
-        scan_angle_rank_v=[] # format 1-5: 1 byte integer in range [-90,90] degrees (see LAS 1.4 specifications)
-        scan_angle_v=[] # format 6-10: 2 bytes integer with increment equivalent to 0.006 degree.
-        ANGLE_INC = 0.006 # angle increment for LAS 1.4 format 6-10
-        gpstime_v=[]
-
-        # Extra Bytes vectors
-        pulse_width_v = []
-        amplitude_v = []
-
-        # Waveform vectors
-        wave_packet_desc_index_v=[]  # to be replaced to an array of ones at the end
-        byte_offset_to_waveform_data_v=[]
-        waveform_packet_size_v=[]
-        return_point_waveform_loc_v=[]
-        x_t_v=[]
-        y_t_v=[]
-        z_t_v=[]
-        
         if (self.ifFixedGain):
             receiveWaveGain=float(self.fixedGain)
             print('Receiver gain: ', receiveWaveGain)
         else:
             #Generally compute the proper gain
-            #Make a copy of the current position, go through the waveform values for a statistical distribution of the waveform amplitude
-            waveMax = -1
-            tmp2 = dartfile.tell()
-            for cnt in range(nbPulses):
-                dartfile.seek(tmp2+waveform_parameter_length)
-                try:
-                    wave = dartfile.read(convolved_Length)
-                except:
-                    tb = sys.exc_info()[2]
-                    raise IOError("Reading failed on input DART LIDARIMAGE file while reading waveform of each pulse" + dartFileName, tb)
-                wave_data = np.array(struct.unpack(waveIterFormat %nbBinsConvolved, wave))
-#                 wave_data_nonzero = [val for val in wave_data if val > 0.0];
-                tmpMax = wave_data.max()
-                if tmpMax>waveMax:
-                    waveMax = tmpMax
-                tmp2 = dartfile.tell()    
-                tmp2 += posOffsetPerPulse
+            #Maximum of the waveforms is computed on the memory map, and cached next to dartFileName
+            waveMax = waveform_max(dartFileName, pulses, self.chunk_size)
             if not waveMax > 0:
                 raise ValueError('Cannot find the wave maximum, please define a gain')
             
             receiveWaveGain=float(self.maxOutput)/(2*waveMax)
             print('Receiver gain computed according to the waveform maximum: ', receiveWaveGain)
 
+        digitizer_gain = 1 / receiveWaveGain
+        digitizer_offset = 0
+
+        # LAS headers must be complete before streaming points to the files
+        las_headers = [self._create_las_header(lasFormat, nbBinsConvolved, timeStep_in_pico_second,
+                                               digitizer_gain, digitizer_offset)
+                       for lasFormat, lasFileName in outputs]
+
         print("nbPulses: {}".format(nbPulses))
-        import time
         start = time.time()
         print('start time: {}'.format(start))
-        for cnt in range(nbPulses):
-            dartfile.seek(tmp)
-            try:
-                pulseInfo = dartfile.read(waveform_parameter_length)
-            except:
-                tb = sys.exc_info()[2]
-                raise IOError("Reading failed on input DART LIDARIMAGE file while reading parameter of each pulse" + dartFileName, tb)
-            #end try
-            pulse_info=struct.unpack(waveform_parameter_format, pulseInfo)
-            try:
-                wave = dartfile.read(convolved_Length)
-            except:
-                tb = sys.exc_info()[2]
-                raise IOError("Reading failed on input DART LIDARIMAGE file while reading waveform of each pulse" + dartFileName, tb)
-            #end try
-            wave_data = np.array(list(struct.unpack(waveIterFormat %nbBinsConvolved, wave)))
-            if any(wave_data>0):
-                y_decomp = (wave_data * receiveWaveGain).astype(int)
-                if any(y_decomp > 0):
-                    y_decomp[y_decomp > self.maxOutput] = self.maxOutput # should never happen
-                    # for i in range(nbBinsConvolved):
-                    #     c=int(wave_data[i]*receiveWaveGain)  #approximated count < 128
-                    #     if c>self.maxOutput:
-                    #         c=self.maxOutput
-                    #     y_decomp.append(c)
-
-                    # if (self.ifOutputNbPhotonPerPulse):
-                    #     sum_wave_data = 0
-                    #     for j in range(len(wave_data)):
-                    #         sum_wave_data += wave_data[j]
-                    #     self.addToNbPhotonPerPulseMap(pulse_info[12], pulse_info[13], sum_wave_data);
-
-        #             #ajust the gain and output regarding automatic gain control per pulse.
-        #             maxCount=1e-8
-        #             for j in range(len(wave_data)):
-        #                 if self.ifSolarNoise:
-        #                     wave_data[j]+=self.snMap[pulse_info[12]][pulse_info[13]]
-        #                 if not wave_data[j] == 0.0 and wave_data[j]>maxCount:
-        #                     maxCount=wave_data[j]
-        #
-        #             if maxCount==1e-8:
-        #                 tmp = dartfile.tell() #saves current position in input file before jump to the data of the next waveform
-        #                 tmp += posOffsetPerPulse
-        #                 continue
-        #
-        #             if (maxCntGlobe<maxCount):
-        #                 maxCntGlobe=maxCount
-
-
-                    nbBinsToCenterFOV = pulse_info[11] # Number of bins from sensor to center of FOV
-                    distToCenterFOV = nbBinsToCenterFOV*distStep
-
-                    distToBeginWave=distToCenterFOV+speedOfLightPerNS*pulse_info[9] #pulse_info[9] is negative
-
-                    #!!!!!!!!!!!!!!!!!!Making the vector looking upward (z_t>0) for ALS device to keep consistent with LAS format
-                    # see https://github.com/ASPRSorg/LAS/wiki/Waveform-Data-Packet-Descriptors-Explained
-                    x_t = -pulse_info[3]
-                    y_t = -pulse_info[4]
-                    z_t = -pulse_info[5]
-
-                    x0_abs = pulse_info[6] - x_t/2*distToBeginWave #Divided by 2 change from distance to waveform (2 way)
-                    y0_abs = pulse_info[7] - y_t/2*distToBeginWave
-                    z0_abs = pulse_info[8] - z_t/2*distToBeginWave
-
-                    # gpsTime = float(pulse_info[14]) / self.prf
-                    gpsTime = float(pulse_info[14]) # pulse ID (0-based)
-
-                    scan_angle_rank = int(round(pulse_info[0]))
-                    scan_angle = int(round(pulse_info[0]/ANGLE_INC))
-
-                    x_per_bin = x_t * distStep / 2
-                    y_per_bin = y_t * distStep / 2
-                    z_per_bin = z_t * distStep / 2
-
-
-                    if self.ifWriteWaveform:
-                        x_t_pico_second = x_per_bin / timeStep_in_pico_second
-                        y_t_pico_second = y_per_bin / timeStep_in_pico_second
-                        z_t_pico_second = z_per_bin / timeStep_in_pico_second
-                        currentWritingPosWave = waveformfile.tell()
-
-
-                    # y_decomp_arr = np.array(y_decomp)
-                    y_decomp_arr = y_decomp
-                    # indexes_peaks = findZeroCrossingPeaks(y_decomp_arr, self.waveNoiseThreshold)
-
-                    ###Gaussian Decomposition
-                    # if len(indexes_peaks)>0:
-                        # in_x = np.array(range(len(y_decomp)))+0.5 ## commented on C++ binding of Gaussian Decomposition
-                        # out = gaussian_decomposition(in_x, y_decomp_arr, indexes_peaks) ## commented on C++ binding of Gaussian Decomposition
-                    out = GaussianDecomposition(y_decomp_arr.astype(float), float(self.waveNoiseThreshold), 3)
-                    # if cnt in [949, 950]:
-                    #     indexes_peaks = findZeroCrossingPeaks(y_decomp_arr, self.waveNoiseThreshold)
-                    #     in_x = np.array(range(len(y_decomp))) ## commented on C++ binding of Gaussian Decomposition
-                    #     out = gaussian_decomposition(in_x, y_decomp_arr, indexes_peaks) ## commented on C++ binding of Gaussian Decomposition
-                    #     out = np.reshape(out, (-1,3))
-                    #     in_x = np.array(range(len(y_decomp)))
-                    #     fit = np.zeros(y_decomp_arr.size)
-                    #     for i in range(out.shape[0]):
-                    #         fit += out[i,0] * np.exp(-(in_x - out[i,1])**2 / (2 * out[i,2]**2))
-                    #     plt.clf()
-                    #     plt.plot(in_x, y_decomp_arr, color='b')
-                    #     plt.plot(in_x, fit, color='r')
-                    #     plt.show()
-
-                    # if out.success: ## commented on C++ binding of Gaussian Decomposition
-                    if len(out)>0:
-                        out = np.reshape(out, (-1,3))
-                        out = out[out[:,0]>0, :] # amplitude 0 can occure, e.g. cnt=949
-                        # print len(out.best_values)/3, out.best_values['g0_amplitude']
-                        if self.ifWriteWaveform:
-                            for c in y_decomp:
-                                waveformfile.write(struct.pack('<'+self.waveformAmplitudeFomat,c))
-                        countPulses+=1
-                        pulsesInBuffer+=1
-                        # nbPointsDecomp = len(out.best_values)//3 ## commented on C++ binding of Gaussian Decomposition
-                        nbPointsDecomp = out.shape[0]
-
-                        for i in range(nbPointsDecomp):
-                            # ptsPrefix = 'g' + str(i) + '_'
-                            # ptsAmp = out.best_values[ptsPrefix+'amplitude'] ## commented on C++ binding of Gaussian Decomposition
-                            # ptsSigma = out.best_values[ptsPrefix+'sigma'] ## commented on C++ binding of Gaussian Decomposition
-                            # ptsCenter = out.best_values[ptsPrefix+'center'] ## commented on C++ binding of Gaussian Decomposition
-    #                         print ptsAmp,   ptsCenter, x0, y0, z0, x_t, y_t, z_tout[i, 1]
-                            ptsAmp = out[i, 0]
-                            ptsSigma = out[i, 2]
-                            ptsCenter = out[i, 1]+0.5
-                            x_abs = x0_abs - x_per_bin*ptsCenter
-                            y_abs = y0_abs - y_per_bin*ptsCenter
-                            z_abs = z0_abs - z_per_bin*ptsCenter
-
-                            if self.typeOut == 1:  # Peak amplitude of the Gaussian profile
-                                intensity = ptsAmp/ptsSigma
-                            elif self.typeOut == 2:# Integral of the Gaussian profile
-                                intensity = ptsAmp
-                            elif self.typeOut == 3:# Standard deviation of the Gaussian profile
-                                intensity = ptsSigma * 10.0 #To not making the value too small
-                            elif self.typeOut == 4: # Intensity in the RIEGL way: waveform=I*e^((t-u)/sigma^2)
-                                intensity = ptsAmp / (ptsSigma * math.sqrt(2 * math.pi))
-                            else:
-                                print('Error: the output type option is not supported')
-                                quit()
-
-
-                            # All formats variables
-                            # xyz are scaled inside las object
-                            # x_v.append(int(round( x_abs / self.scale)))
-                            # y_v.append(int(round( y_abs / self.scale)))
-                            # z_v.append(int(round( z_abs / self.scale)))
-                            x_v.append(x_abs)
-                            y_v.append(y_abs)
-                            z_v.append(z_abs)
-                            intensity_v.append(intensity)
-                            if self.lasFormat in range(6, 11):
-                                scan_angle_v.append(scan_angle)
-                            else:
-                                scan_angle_rank_v.append(scan_angle_rank)
-                            gpstime_v.append(gpsTime)
-                            return_num_v.append(i+1)
-                            num_returns_v.append(nbPointsDecomp)
-
-
-                            # Extra Bytes
-                            if self.extra_bytes:
-                                pulse_width_v.append(ptsSigma * (2 * math.sqrt(2 * math.log(2)))) # Full Width at Half Maximum
-                                # print('{} {} {} {}'.format(cnt, ptsAmp, intensity, ptsSigma))
-                                amplitude_v.append(10*math.log10(intensity/self.minimumIntensity))
-
-                            # Waveform
-                            if self.ifWriteWaveform:
-                                byte_offset_to_waveform_data_v.append(currentWritingPosWave)
-                                waveform_packet_size_v.append(nbBinsConvolved * self.nbBytePerWaveAmplitude)
-                                return_point_waveform_loc_v.append(ptsCenter * timeStep_in_pico_second)
-                                x_t_v.append(x_t_pico_second)
-                                y_t_v.append(y_t_pico_second)
-                                z_t_v.append(z_t_pico_second)
-
-            tmp = dartfile.tell() #saves current position in input file before jump to the data of the next waveform
-            tmp += posOffsetPerPulse;
-
-            if ((not feedback==0) and (cnt / feedback) > tmpIndicatorPast):
-                tmpIndicatorNew = int(cnt / feedback)
-                for i in range(tmpIndicatorPast, tmpIndicatorNew):
-                    print('pulse info: %f %f %f' % (pulse_info[6], pulse_info[7], pulse_info[8]))
-                    print('elapsed time: {}'.format(time.time()-start))
-                    print('{}%'.format(i*10))
-                    sys.stdout.flush()
-                tmpIndicatorPast=tmpIndicatorNew
-
-                #end of iterative reading the waveform
-
+        self.stats = stats = dict(nb_pulses=nbPulses, pulses=0, points=0, bytes_read=hearder_length,
+                                  time_decode=0., time_decomposition=0., time_points=0., time_write=0.,
+                                  time_total=0., pulses_per_second=0., points_per_second=0.)
+
+        # points are converted and written by chunks of pulses to keep memory bounded
+        lasWriters = []
+        nbUnvalidReturns = [0] * len(outputs)
+        nbCeiledIntensities = [0] * len(outputs)
+
+        # gaussian decomposition cache
+        cache = None
+        if self.decomposition_cache:
+            backend = 'numpy' if GaussianDecomposition is None else 'gdecomp'
+            cacheKey = '{} {} {} {} {}'.format(content_hash(dartFileName), self.waveNoiseThreshold,
+                                               repr(receiveWaveGain), self.maxOutput, backend)
+            cache = DecompositionCache(dartFileName + '.decomposition', cacheKey)
+            if cache.nbPulses > 0:
+                print('Gaussian decomposition of {} pulses read from cache: {}'.format(cache.nbPulses,
+                                                                                      cache.cacheDir))
+
+        pool = None
+        if self.ncpu > 1 and (cache is None or cache.nbPulses < nbPulses):
+            pool = Pool(self.ncpu)
+        try:
+            for (lasFormat, lasFileName), las_header in zip(outputs, las_headers):
+                lasWriters.append(laspy.open(lasFileName, mode='w', header=las_header))
+
+            tic = time.perf_counter()
+            for chunk_start, chunk in iter_pulse_chunks(pulses, self.chunk_size):
+                chunk_waves = chunk['waveform'].astype(float)
+                toc = time.perf_counter()
+                stats['time_decode'] += toc - tic
+                stats['bytes_read'] += chunk.nbytes
+                tic = toc
+
+                ###Gaussian Decomposition
+                # pulses already in cache are not decomposed again
+                nbCached = 0 if cache is None else min(max(cache.nbPulses - chunk_start, 0), len(chunk))
+                decompositions = [] if nbCached == 0 else cache.get(chunk_start, nbCached)
+                if nbCached < len(chunk):
+                    newDecompositions = self._decompose(dartFileName, chunk_waves[nbCached:],
+                                                        chunk_start + nbCached, receiveWaveGain, pool)
+                    if cache is not None:
+                        cache.append(chunk_start + nbCached, newDecompositions)
+                    decompositions += newDecompositions
+                toc = time.perf_counter()
+                stats['time_decomposition'] += toc - tic
+                tic = toc
+
+                # points are computed for all the returns of the chunk at once
+                waveformOffset = off_waveformfile + countPulses * waveformPacketSize if ifWriteWaveform else None
+                vectors, kept_pulses = self._chunk_points(chunk, decompositions, distStep, timeStep_in_pico_second,
+                                                          waveformOffset, waveformPacketSize)
+                countPulses += len(kept_pulses)
+                toc = time.perf_counter()
+                stats['time_points'] += toc - tic
+                tic = toc
+
+                cnt = chunk_start + len(chunk) - 1
+                if ((not feedback==0) and (cnt / feedback) > tmpIndicatorPast):
+                    tmpIndicatorNew = int(cnt / feedback)
+                    pulse_info = chunk[-1]
+                    for i in range(tmpIndicatorPast, tmpIndicatorNew):
+                        print('pulse info: %f %f %f' % (pulse_info['platform_x'], pulse_info['platform_y'],
+                                                        pulse_info['platform_z']))
+                        print('elapsed time: {}'.format(time.time()-start))
+                        print('{}%'.format(i*10))
+                        sys.stdout.flush()
+                    tmpIndicatorPast=tmpIndicatorNew
+
+                for waveformfile in waveformfiles.values():
+                    self._write_waveforms(waveformfile, chunk_waves[kept_pulses], receiveWaveGain)
+
+                for iout, (lasFormat, lasFileName) in enumerate(outputs):
+                    nbUnvalid, nbCeiled = self._write_las_chunk(lasWriters[iout], las_headers[iout],
+                                                                lasFormat, vectors)
+                    nbUnvalidReturns[iout] += nbUnvalid
+                    nbCeiledIntensities[iout] += nbCeiled
+                toc = time.perf_counter()
+                stats['time_write'] += toc - tic
+
+                stats['pulses'] += len(chunk)
+                stats['points'] += len(vectors['x'])
+                self._update_stats(stats, start)
+                logger.debug('Converted %(pulses)d/%(nb_pulses)d pulses, %(points)d points, '
+                             '%(pulses_per_second).0f pulses/s, %(points_per_second).0f points/s', stats)
+                if self.progress is not None:
+                    self.progress(dict(stats))
+                tic = time.perf_counter()
+        finally:
+            for lasWriter in lasWriters:
+                lasWriter.close()
+            for waveformfile in waveformfiles.values():
+                waveformfile.close()
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if cache is not None:
+                cache.close()
         print('100%')
-        
-#         print(points)
-
-##################HEADER#################
 
         stop = time.time()
         print(stop-start)
+        self._update_stats(stats, start)
+        logger.info('Converted %(pulses)d pulses to %(points)d points in %(time_total).1f s '
+                    '(decode %(time_decode).1f s, decomposition %(time_decomposition).1f s, '
+                    'points %(time_points).1f s, write %(time_write).1f s): '
+                    '%(pulses_per_second).0f pulses/s, %(points_per_second).0f points/s', stats)
+
+        for iout, (lasFormat, lasFileName) in enumerate(outputs):
+            if nbUnvalidReturns[iout] > 0:
+                Nmax = 2**4-1 if lasFormat in range(6, 11) else 2**3-1
+                warnings.warn(f'{nbUnvalidReturns[iout]} points with a Return Number > {Nmax} were removed.')
+            if nbCeiledIntensities[iout] > 0:
+                warnings.warn(f'{nbCeiledIntensities[iout]} points exceeding LAS maximum intensity (UINT16) were ceiled to 65535.')
+
+        del pulses  # close memory map
+
+        if ifWriteWaveform:
+            self.digitizer_gain = digitizer_gain
+            self.digitizer_offset = digitizer_offset
+
+        return digitizer_offset, digitizer_gain
 
+    def _decompose(self, dartFileName, waves, start, receiveWaveGain, pool=None):
+        """
+        Gaussian decomposition of the waveforms of consecutive pulses, in parallel if pool is defined.
 
-        las = laspy.create(file_version=str(self.lasVersion), point_format=self.lasFormat)
-        las.header.scales=[self.scale]*3
-        las.header.system_identifier='DART5                           '   # length of 32!!!
-        las.header.generating_software = 'DART2LAS.py                     '  # length of 32!!!
+        Parameters
+        ----------
+        dartFileName: str
+            Path to LIDAR_IMAGE_FILE.binary, read by the worker processes.
+        waves: numpy.ndarray
+            Waveforms of the pulses.
+        start: int
+            Index of the first pulse.
+        receiveWaveGain: float
+            Receiver gain.
+        pool: multiprocessing.Pool
 
-        digitizer_gain = 1 / receiveWaveGain
-        digitizer_offset = 0
+        Returns
+        -------
+        list
+            See decompose_waveforms.
+        """
+        if pool is None:
+            return decompose_waveforms(waves, receiveWaveGain, self.maxOutput, self.waveNoiseThreshold)
+
+        # shards are decomposed by worker processes reading the memory map of DART file,
+        # results are merged in pulse order
+        bounds = np.linspace(start, start + len(waves), self.ncpu + 1).astype(int)
+        shards = pool.starmap(_decompose_pulses,
+                              [(dartFileName, a, b, receiveWaveGain, self.maxOutput,
+                                self.waveNoiseThreshold) for a, b in zip(bounds[:-1], bounds[1:])])
+        return [out for shard in shards for out in shard]
+
+    @staticmethod
+    def _update_stats(stats, start):
+        """
+        Update total time and throughput of conversion statistics.
+
+        Parameters
+        ----------
+        stats: dict
+            Conversion statistics, see DART2LAS.
+        start: float
+            Beginning time of the conversion, as returned by time.time()
+        """
+        stats['time_total'] = time.time() - start
+        if stats['time_total'] > 0:
+            stats['pulses_per_second'] = stats['pulses'] / stats['time_total']
+            stats['points_per_second'] = stats['points'] / stats['time_total']
+
+    def _create_las_header(self, lasFormat, nbBinsConvolved, timeStep_in_pico_second, digitizer_gain, digitizer_offset):
+        """
+        Create the LAS header, including extra bytes and waveform packet descriptor.
+
+        Parameters
+        ----------
+        lasFormat: int
+            LAS point format
+        nbBinsConvolved: int
+            Number of samples of the waveforms.
+        timeStep_in_pico_second: float
+            Temporal sample spacing of the waveforms.
+        digitizer_gain: float
+        digitizer_offset: float
 
+        Returns
+        -------
+        laspy.LasHeader
+        """
+        las_header = laspy.LasHeader(version=str(self.lasVersion), point_format=lasFormat)
+        las_header.scales=[self.scale]*3
+        las_header.system_identifier='DART5                           '   # length of 32!!!
+        las_header.generating_software = 'DART2LAS.py                     '  # length of 32!!!
 
         if self.extra_bytes:
-            las.add_extra_dims([
+            las_header.add_extra_dims([
                 laspy.ExtraBytesParams(name="pulse_width",
                                        description="Full width at half maximum [ns]",
                                        type='f8'),
@@ -559,26 +753,9 @@ class DART2LAS(object):
             # outFile.header.vlrs[0].description = description + "\x00"*(32-len(description))
 
 
-        if self.ifWriteWaveform:
-            # outFile.header.set_waveform_data_packets_external(1)
-            # outFile.header.set_waveform_data_packets_internal(
-            #     0)  # Equivalent as "outFile.header.set_global_encoding(4)"
-
-            las.header.global_encoding.waveform_data_packets_external = True
+        if lasFormat in waveform_formats:
+            las_header.global_encoding.waveform_data_packets_external = True
 
-            # gencod = bin(outFile.header.get_global_encoding())[2:].zfill(8)
-            # print("Global Encoding ", gencod)
-            # print("   - Waveform Data Packets Internal ", gencod[-2])
-            # print("   - Waveform Data Packets External ", gencod[-3])
-
-            self.digitizer_gain = digitizer_gain
-            self.digitizer_offset = digitizer_offset
-
-            # add vlr
-
-            # wvf_str_format = '<BBLLdd'
-            # record_data = struct.pack(wvf_str_format, 16, 0, nbBinsConvolved, 1000, digitizer_gain, digitizer_offset)
-            # wvf_str = laspy.vlrs.known.WaveformPacketStruct.from_buffer_copy(record_data)
             bits_per_sample = 16
             waveform_compression_type = 0
             number_of_samples = nbBinsConvolved
@@ -586,106 +763,215 @@ class DART2LAS(object):
             wvf_str = laspy.vlrs.known.WaveformPacketStruct(bits_per_sample, waveform_compression_type, number_of_samples,
                                                             temporal_time_spacing, digitizer_gain, digitizer_offset)
 
-
-            # wvf_str.temporal_time_spacing = int(1000)
-            # wvf_str.digitizer_gain = 1.0
-            # wvf_str.digitizer_offset = 0.0
-
             wvf_vlr = laspy.vlrs.known.WaveformPacketVlr(100, 'DART waveforms')
             wvf_vlr.parsed_record = wvf_str
 
-            las.vlrs.append(wvf_vlr)
-            wave_packet_desc_index_v = [1] * len(x_v)  # select the wavepacket record_id: 1 is record_id-99, here record_id is 100
-
-            #
-            #
-            # body_fmt = laspy.util.Format(None)
-            # body_fmt.add("bits_per_sample", "ctypes.c_ubyte", 1)
-            # body_fmt.add("waveform_compression_type", "ctypes.c_ubyte", 1)
-            # body_fmt.add("number_of_samples", "ctypes.c_ulong", 1)
-            # body_fmt.add("temporal_time_spacing", "ctypes.c_ulong", 1)
-            # body_fmt.add("digitizer_gain", "ctypes.c_double", 1)
-            # body_fmt.add("digitizer_offset", "ctypes.c_double", 1)
-            #
-            # print('body_fmt.pt_fmt_long', body_fmt.pt_fmt_long)
-            #
-            # vlr_body_1 = struct.pack(body_fmt.pt_fmt_long, 16, waveform_compression_type, nbBinsConvolved,
-            #                          temporal_time_spacing, digitizer_gain, digitizer_offset)
-            # # vlr_body_2 = struct.pack(body_fmt.pt_fmt_long, 8, waveform_compression_type, nbBinsConvolved, temporal_time_spacing, digitizer_gain, digitizer_offset)
-            #
-            # old_vlrs = outFile.header.vlrs
-            # wave_vlr = laspy.vlrs.VLR(user_id='LASF_Spec', record_id=100, record_data=vlr_body_1)
-            # # wave_vlr2 = laspy.header.VLR(user_id = 'LASF_Spec', record_id = 101, VLR_body = vlr_body_2)
-            # old_vlrs.append(wave_vlr)
-            # # old_vlrs.append(wave_vlr2)
-            # outFile.header.vlrs = old_vlrs
-
-
-    ##################POINTS#################
+            las_header.vlrs.append(wvf_vlr)
+
+        return las_header
+
+    def _chunk_points(self, chunk, decompositions, distStep, timeStep_in_pico_second,
+                      waveformOffset=None, waveformPacketSize=None):
+        """
+        Compute the points of a chunk of pulses from their gaussian decomposition,
+        as arrays over all the returns of the chunk.
+
+        Parameters
+        ----------
+        chunk: numpy.ndarray
+            Pulses, see binary.read_pulses.
+        decompositions: list
+            Gaussian decomposition of each pulse of chunk, see decompose_waveforms.
+        distStep: float
+            Distance between two bins of the waveforms.
+        timeStep_in_pico_second: float
+            Temporal sample spacing of the waveforms.
+        waveformOffset: int
+            Offset in the waveform data packets file of the first pulse with returns.
+            If None, waveform packet variables are not computed.
+        waveformPacketSize: int
+            Size of a waveform data packet.
+
+        Returns
+        -------
+        (dict, numpy.ndarray)
+            Points variables named as LAS dimensions,
+            and index in chunk of the pulses with returns (i.e. which waveform is written).
+        """
+        kept_pulses = np.flatnonzero([out is not None and len(out) > 0 for out in decompositions])
+
+        # stacked returns (pulse, amplitude, center, sigma)
+        pulse, gaussian = pack_decompositions(0, decompositions)
+        valid = gaussian[:, 0] > 0 # amplitude 0 can occure, e.g. cnt=949
+        pulse = pulse[valid]
+        ptsAmp = gaussian[valid, 0]
+        ptsCenter = gaussian[valid, 1] + 0.5
+        ptsSigma = gaussian[valid, 2]
+
+        nbPointsDecomp = np.bincount(pulse, minlength=len(chunk))
+        firstPoint = np.cumsum(nbPointsDecomp) - nbPointsDecomp
+        return_number = np.arange(len(pulse)) - firstPoint[pulse] + 1
+
+        # pulse geometry
+        distToCenterFOV = chunk['nb_bins_to_center'] * distStep # Number of bins from sensor to center of FOV
+        distToBeginWave = distToCenterFOV + speedOfLightPerNS * chunk['time_convolved'] # time_convolved is negative
+
+        #!!!!!!!!!!!!!!!!!!Making the vector looking upward (z_t>0) for ALS device to keep consistent with LAS format
+        # see https://github.com/ASPRSorg/LAS/wiki/Waveform-Data-Packet-Descriptors-Explained
+        x_t = -chunk['dir_x']
+        y_t = -chunk['dir_y']
+        z_t = -chunk['dir_z']
+
+        x0_abs = chunk['platform_x'] - x_t/2*distToBeginWave #Divided by 2 change from distance to waveform (2 way)
+        y0_abs = chunk['platform_y'] - y_t/2*distToBeginWave
+        z0_abs = chunk['platform_z'] - z_t/2*distToBeginWave
+
+        x_per_bin = x_t * distStep / 2
+        y_per_bin = y_t * distStep / 2
+        z_per_bin = z_t * distStep / 2
+
+        if self.typeOut == 1:  # Peak amplitude of the Gaussian profile
+            intensity = ptsAmp/ptsSigma
+        elif self.typeOut == 2:# Integral of the Gaussian profile
+            intensity = ptsAmp
+        elif self.typeOut == 3:# Standard deviation of the Gaussian profile
+            intensity = ptsSigma * 10.0 #To not making the value too small
+        elif self.typeOut == 4: # Intensity in the RIEGL way: waveform=I*e^((t-u)/sigma^2)
+            intensity = ptsAmp / (ptsSigma * math.sqrt(2 * math.pi))
+        else:
+            print('Error: the output type option is not supported')
+            quit()
+
+        # All formats variables
+        # xyz are scaled inside las object
+        vectors = dict(x=x0_abs[pulse] - x_per_bin[pulse]*ptsCenter,
+                       y=y0_abs[pulse] - y_per_bin[pulse]*ptsCenter,
+                       z=z0_abs[pulse] - z_per_bin[pulse]*ptsCenter,
+                       intensity=intensity,
+                       return_number=return_number,
+                       number_of_returns=nbPointsDecomp[pulse],
+                       # format 1-5: 1 byte integer in range [-90,90] degrees (see LAS 1.4 specifications)
+                       scan_angle_rank=np.round(chunk['look_angle']).astype(int)[pulse],
+                       # format 6-10: 2 bytes integer with increment equivalent to 0.006 degree.
+                       scan_angle=np.round(chunk['look_angle']/ANGLE_INC).astype(int)[pulse],
+                       # gps_time=chunk['pulse_id'][pulse] / self.prf
+                       gps_time=chunk['pulse_id'].astype(float)[pulse]) # pulse ID (0-based)
+
+        # Extra Bytes
+        if self.extra_bytes:
+            vectors['pulse_width'] = ptsSigma * (2 * math.sqrt(2 * math.log(2))) # Full Width at Half Maximum
+            vectors['amplitude'] = 10*np.log10(intensity/self.minimumIntensity)
+
+        # Waveform
+        if waveformOffset is not None:
+            # waveforms of pulses with returns are written contiguously
+            pulseOffset = np.zeros(len(chunk), dtype=np.int64)
+            pulseOffset[kept_pulses] = waveformOffset + np.arange(len(kept_pulses)) * waveformPacketSize
+            vectors['wavepacket_offset'] = pulseOffset[pulse]
+            vectors['wavepacket_size'] = np.full(len(pulse), waveformPacketSize)
+            vectors['return_point_wave_location'] = ptsCenter * timeStep_in_pico_second
+            vectors['x_t'] = (x_per_bin / timeStep_in_pico_second)[pulse]
+            vectors['y_t'] = (y_per_bin / timeStep_in_pico_second)[pulse]
+            vectors['z_t'] = (z_per_bin / timeStep_in_pico_second)[pulse]
+
+        return vectors, kept_pulses
+
+    def _write_waveforms(self, waveformfile, waves, receiveWaveGain):
+        """
+        Write digitized waveforms to the waveform data packets file, in a single call.
+
+        Parameters
+        ----------
+        waveformfile: file object
+            Waveform data packets file (.wdp)
+        waves: numpy.ndarray
+            Waveforms of shape (nbPulses, nbBinsConvolved)
+        receiveWaveGain: float
+            Gain applied to waveforms before digitization.
+        """
+        y_decomp = (waves * receiveWaveGain).astype(int)
+        y_decomp[y_decomp > self.maxOutput] = self.maxOutput # should never happen
+        waveformfile.write(y_decomp.astype('<'+self.waveformAmplitudeFomat).tobytes())
+
+    def _write_las_chunk(self, lasWriter, las_header, lasFormat, vectors):
+        """
+        Write a chunk of points to LAS file.
+
+        Parameters
+        ----------
+        lasWriter: laspy.LasWriter
+        las_header: laspy.LasHeader
+            Header the writer was opened with.
+        lasFormat: int
+            LAS point format
+        vectors: dict
+            Points variables, either lists or arrays, named as LAS dimensions.
+
+        Returns
+        -------
+        (int, int)
+            Number of points removed because of a Return Number too high,
+            and number of points with ceiled intensity.
+        """
+
         # remove returns more than maximum (2^3 for formats 1-5)
-        if self.lasFormat in range(6, 11):
+        if lasFormat in range(6, 11):
             Nmax = 2**4-1
         else:
             Nmax = 2**3-1
 
-        num_returns_v = np.array(num_returns_v)
+        num_returns_v = np.array(vectors['number_of_returns'])
         num_returns_v[num_returns_v>Nmax]=Nmax
         # remove the echoes with return number superior to Nmax
         # this strategy does not ake into account there value, maybe only the greatest intensity echoes
         # should be kept, renumbering them.
-        unvalid = np.array(return_num_v) > Nmax
-        if unvalid.any():
-            warnings.warn(f'{unvalid.sum()} points with a Return Number > {Nmax} were removed.')
+        unvalid = np.array(vectors['return_number']) > Nmax
         valid_returns = ~unvalid
 
+        if not valid_returns.any():
+            return unvalid.sum(), 0
+
+        las = laspy.LasData(las_header)
 
         # All formats variables
-        if self.lasFormat not in [0, 2]:
-            las.gps_time = np.array(gpstime_v)[valid_returns]
-        las.x = np.array(x_v)[valid_returns]
-        las.y = np.array(y_v)[valid_returns]
-        las.z = np.array(z_v)[valid_returns]
-        arr = np.array(intensity_v)[valid_returns].astype(int)
+        if lasFormat not in [0, 2]:
+            las.gps_time = np.array(vectors['gps_time'])[valid_returns]
+        las.x = np.array(vectors['x'])[valid_returns]
+        las.y = np.array(vectors['y'])[valid_returns]
+        las.z = np.array(vectors['z'])[valid_returns]
+        arr = np.array(vectors['intensity'])[valid_returns].astype(int)
         ceil_v = (arr>65535) # UINT16 maximum intensity value, encoding of LAS.
         if ceil_v.any():
-            warnings.warn(f'{ceil_v.sum()} points exceeding LAS maximum intensity (UINT16) were ceiled to 65535.')
             arr[ceil_v] = 65535
         las.intensity = arr
-        las.return_number = np.array(return_num_v)[valid_returns]
-        las.number_of_returns = np.array(num_returns_v)[valid_returns]
+        las.return_number = np.array(vectors['return_number'])[valid_returns]
+        las.number_of_returns = num_returns_v[valid_returns]
 
         # Scan angle
-        if self.lasFormat in range(6, 11):
-            las.scan_angle = np.array(scan_angle_v)[valid_returns]
+        if lasFormat in range(6, 11):
+            las.scan_angle = np.array(vectors['scan_angle'])[valid_returns]
         else:
-            las.scan_angle_rank = np.array(scan_angle_rank_v)[valid_returns]
+            las.scan_angle_rank = np.array(vectors['scan_angle_rank'])[valid_returns]
 
         # Waveforms
-        if self.ifWriteWaveform:
-            # [k for k in las.point_format.dimension_names]
-            las.wavepacket_index = np.array(wave_packet_desc_index_v)[valid_returns]
-            las.wavepacket_offset = np.array(byte_offset_to_waveform_data_v)[valid_returns]
-            las.wavepacket_size = np.array(waveform_packet_size_v)[valid_returns]
-            las.return_point_wave_location = np.array(return_point_waveform_loc_v)[valid_returns]
-            las.x_t = np.array(x_t_v)[valid_returns]
-            las.y_t = np.array(y_t_v)[valid_returns]
-            las.z_t = np.array(z_t_v)[valid_returns]
+        if lasFormat in waveform_formats:
+            # select the wavepacket record_id: 1 is record_id-99, here record_id is 100
+            las.wavepacket_index = np.ones(valid_returns.sum(), dtype=int)
+            las.wavepacket_offset = np.array(vectors['wavepacket_offset'])[valid_returns]
+            las.wavepacket_size = np.array(vectors['wavepacket_size'])[valid_returns]
+            las.return_point_wave_location = np.array(vectors['return_point_wave_location'])[valid_returns]
+            las.x_t = np.array(vectors['x_t'])[valid_returns]
+            las.y_t = np.array(vectors['y_t'])[valid_returns]
+            las.z_t = np.array(vectors['z_t'])[valid_returns]
 
         # Extra Bytes
         if self.extra_bytes:
-            las.pulse_width=np.array(pulse_width_v)[valid_returns]
-            las.amplitude=np.array(amplitude_v)[valid_returns]
-
-
-        las.write(lasFileName)
-
-        dartfile.close()
+            las.pulse_width=np.array(vectors['pulse_width'])[valid_returns]
+            las.amplitude=np.array(vectors['amplitude'])[valid_returns]
 
-        if self.ifWriteWaveform:
-            waveformfile.close()
+        lasWriter.write_points(las.points)
 
-
-        return digitizer_offset, digitizer_gain
+        return unvalid.sum(), ceil_v.sum()
                 
     def run(self):
         parser=argparse.ArgumentParser(description='DART2LAS.py script converts a DART LIDAR multi-pulse output file to a LAS File.')
@@ -734,9 +1020,59 @@ class DART2LAS(object):
 
         self.readDARTBinaryFileAndConvert2LAS(args.inputFile, args.outputFile)
 
+# Columns of DetectedPoints.txt converted to LAS, with their type
+dp_columns = {'X(m)': 'float64', 'Y(m)': 'float64', 'Z(m)': 'float64',
+              'ReturnIndx': 'uint8', 'NumberReturns': 'uint8'}
+
+def read_detected_points(inputFile, chunk_size=1000000):
+    """
+    Read DetectedPoints.txt by chunks, parsing only the columns converted to LAS.
+
+    The CSV reader of pyarrow is used if available, otherwise pandas.
+
+    Parameters
+    ----------
+    inputFile: str
+        path to DART output file DetectedPoints.txt
+    chunk_size: int
+        Approximate number of points per chunk.
+
+    Returns
+    -------
+    generator
+        dict of numpy arrays, see dp_columns for names and types.
+    """
+    with open(inputFile, 'r') as f:
+        header = f.readline()
+        names = header.rstrip('\r\n').split('\t')
+        first_line = f.readline()
+        sample = first_line + f.read(2**16)
+    # data lines may have more fields than header, e.g. a trailing tab
+    nb_fields = len(first_line.rstrip('\r\n').split('\t'))
+    names += ['_{}'.format(i) for i in range(len(names), nb_fields)]
+
+    if pacsv is not None:
+        line_length = max(len(sample) / max(sample.count('\n'), 1), 1)
+        # blocks must hold the header and whole lines
+        block_size = max(int(chunk_size * line_length),
+                         2 * (len(header) + max(map(len, sample.splitlines()), default=0)))
+        reader = pacsv.open_csv(
+            inputFile,
+            read_options=pacsv.ReadOptions(column_names=names, skip_rows=1,
+                                           block_size=block_size),
+            parse_options=pacsv.ParseOptions(delimiter='\t'),
+            convert_options=pacsv.ConvertOptions(column_types=dp_columns, include_columns=list(dp_columns)))
+        for batch in reader:
+            yield {c: batch.column(c).to_numpy() for c in dp_columns}
+    else:
+        import pandas as pd
+        for data in pd.read_csv(inputFile, sep='\t', names=names, skiprows=1, index_col=False,
+                                usecols=list(dp_columns), dtype=dp_columns, chunksize=chunk_size):
+            yield {c: data[c].to_numpy() for c in dp_columns}
+
 # inputFile=os.path.expanduser('~/DetectedPoints.txt')
 # outputFile=os.path.expanduser('~/DetectedPoints.las')
-def DP2LAS(inputFile, outputFile, lasFormat = 6):
+def DP2LAS(inputFile, outputFile, lasFormat = 6, chunk_size = 1000000):
     """
     Converts DetectedPoints.txt to a LAS file
     Parameters
@@ -748,6 +1084,8 @@ def DP2LAS(inputFile, outputFile, lasFormat = 6):
     lasFormat: int
         Either 1 or 6. LAS Format 1 has a maximum of 7 returns by pulse, while LAS Format 6 has a maximum of 15 returns.
         See LAS 1.4 specifications for details.
+    chunk_size: int
+        Approximate number of points read and written at once, see read_detected_points.
 
     Returns
     -------
@@ -757,53 +1095,41 @@ def DP2LAS(inputFile, outputFile, lasFormat = 6):
     lasVersion = 1.4
     scale = 0.001
 
-    import pandas as pd
-    import laspy
-    data = pd.read_csv(inputFile, sep='\t', index_col=False)
-    extra_col = data.columns[6:]
-
     ### Write header
-    las = laspy.create(file_version=str(lasVersion), point_format=lasFormat)
+    las_header = laspy.LasHeader(version=str(lasVersion), point_format=lasFormat)
 
-    las.header.scales = [scale] * 3
-    las.header.system_identifier = 'DART5                           '  # length of 32!!!
-    las.header.generating_software = 'DART2LAS.py                     '  # length of 32!!!
+    las_header.scales = [scale] * 3
+    las_header.system_identifier = 'DART5                           '  # length of 32!!!
+    las_header.generating_software = 'DART2LAS.py                     '  # length of 32!!!
 
     # digitizer_gain = 1 / receiveWaveGain
     # digitizer_offset = 0
 
-    extra_byte_params = []
-    for c in extra_col:
-        extra_byte_params.append(
-        laspy.ExtraBytesParams(name=c.lower(),
-                               description=c.lower(),
-                               type='double'))
-
     ### Write data
     if lasFormat in range(6, 11):
         Nmax = 2 ** 4 - 1
     else:
         Nmax = 2 ** 3 - 1
 
-    data.loc[data['NumberReturns'] > Nmax,'NumberReturns'] = Nmax
-    # remove the echoes with return number superior to Nmax
-    # this strategy does not ake into account there value, maybe only the greatest intensity echoes
-    # should be kept, renumbering them.
-    data = data.loc[data['ReturnIndx']<=Nmax]
-
-    # All formats variables
-    # outFile.set_gps_time(np.array(gpstime_v)[valid_returns])
-    las.x = data['X(m)']
-    las.y = data['Y(m)']
-    las.z = data['Z(m)']
-    # outFile.set_intensity(np.array(intensity_v)[valid_returns])
-    las.return_number = data['ReturnIndx']
-    las.number_of_returns = data['NumberReturns']
-
-    for c in extra_col:
-        setattr(las, c.lower(), data[c])
-
-    las.write(outputFile)
+    with laspy.open(outputFile, mode='w', header=las_header) as lasWriter:
+        for data in read_detected_points(inputFile, chunk_size):
+            number_of_returns = np.minimum(data['NumberReturns'], Nmax)
+            # remove the echoes with return number superior to Nmax
+            # this strategy does not ake into account there value, maybe only the greatest intensity echoes
+            # should be kept, renumbering them.
+            valid_returns = data['ReturnIndx'] <= Nmax
+
+            las = laspy.LasData(las_header)
+            # All formats variables
+            # outFile.set_gps_time(np.array(gpstime_v)[valid_returns])
+            las.x = data['X(m)'][valid_returns]
+            las.y = data['Y(m)'][valid_returns]
+            las.z = data['Z(m)'][valid_returns]
+            # outFile.set_intensity(np.array(intensity_v)[valid_returns])
+            las.return_number = data['ReturnIndx'][valid_returns]
+            las.number_of_returns = number_of_returns[valid_returns]
+
+            lasWriter.write_points(las.points)
 
 if __name__ == '__main__':
 
@@ -110,6 +110,319 @@ def detect_peaks(y, thres=0.3, min_dist=3):
     return peaks
 
 
+def _suppress_close_peaks(y, rows, cols, min_dist, right_dist=None):
+    """
+    Non-maximum suppression of peaks of several waveforms, vectorized over waveforms.
+
+    Peaks are processed by decreasing amplitude, each kept peak removing the peaks closer than min_dist,
+    as in findZeroCrossingPeaks. Peaks of equal amplitude are processed from first to last
+    (the order of np.argsort used in findZeroCrossingPeaks is not defined for equal values).
+
+    Parameters
+    ----------
+    y : ndarray
+        2D waveforms (n_pulses, n_bins).
+    rows, cols : ndarray
+        Waveform and bin index of peaks.
+    min_dist : int
+        Minimum distance between peaks.
+    right_dist : int
+        Minimum distance to the peaks on the right, by default min_dist.
+
+    Returns
+    -------
+    (ndarray, ndarray)
+        CSR-style peak offsets (n_pulses+1) and bin indices: peaks of waveform i are
+        indices[offsets[i]:offsets[i+1]], in increasing order.
+    """
+    if right_dist is None:
+        right_dist = min_dist
+    counts = np.bincount(rows, minlength=y.shape[0])
+    if min_dist > 1 and rows.size > 0:
+        # peaks of each waveform by decreasing amplitude, as a padded (n_pulses_with_peaks, max_peaks) table
+        order = np.lexsort((cols, -y[rows, cols], rows))
+        rows, cols = rows[order], cols[order]
+        starts = np.cumsum(counts) - counts
+        rank = np.arange(rows.size) - starts[rows]
+        prows, prow_index = np.unique(rows, return_inverse=True)
+        table = np.full((len(prows), counts.max()), -1, dtype=np.int64)
+        table[prow_index, rank] = cols
+        alive = table >= 0
+        # peaks of rank r are processed at once for all waveforms
+        for r in range(table.shape[1]):
+            active = alive[:, r]
+            dist = table[active] - table[active, r:r + 1]
+            near = (dist >= -min_dist) & (dist <= right_dist)
+            near[:, r] = False
+            alive[active] &= ~near
+        rows = prows[np.nonzero(alive)[0]]
+        cols = table[alive]
+        order = np.lexsort((cols, rows))
+        rows, cols = rows[order], cols[order]
+        counts = np.bincount(rows, minlength=y.shape[0])
+
+    offsets = np.zeros(y.shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets, cols.astype(np.int64)
+
+
+def findZeroCrossingPeaksBatch(y, intThreshold=5, min_dist=3):
+    """
+    Detect zero crossing peaks of several waveforms at once, see findZeroCrossingPeaks.
+
+    Parameters
+    ----------
+    y : ndarray
+        2D waveforms (n_pulses, n_bins).
+    intThreshold : float
+        Minimum amplitude of peaks.
+    min_dist : int
+        Minimum distance between peaks, the highest is kept.
+
+    Returns
+    -------
+    (ndarray, ndarray)
+        CSR-style peak offsets (n_pulses+1) and bin indices: peaks of waveform i are
+        indices[offsets[i]:offsets[i+1]], the same as findZeroCrossingPeaks(y[i]).
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> y = np.array([[0, 6, 7, 7, 3, 0, 9, 0], [0, 1, 2, 1, 0, 0, 0, 0]])
+    >>> offsets, indices = findZeroCrossingPeaksBatch(y, 5, 1)
+    >>> [indices[offsets[i]:offsets[i+1]].tolist() for i in range(len(y))]
+    [[2, 6], []]
+    """
+    y = np.asarray(y)
+    nbins = y.shape[1]
+    if nbins < 3:
+        return np.zeros(y.shape[0] + 1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    gradients = np.sign(y[:, 1:] - y[:, :-1])
+    # sign of the next non-zero gradient, 0 if there is none
+    pos = np.where(gradients != 0, np.arange(nbins - 1), nbins - 1)
+    pos = np.minimum.accumulate(pos[:, ::-1], axis=1)[:, ::-1]
+    next_sign = np.take_along_axis(np.hstack([gradients, np.zeros((y.shape[0], 1), gradients.dtype)]), pos, axis=1)
+    is_peak = (gradients[:, :-1] > 0) & (y[:, 1:-1] > intThreshold) & (next_sign[:, 1:] < 0)
+    is_peak &= (y > 0).any(axis=1, keepdims=True)
+    rows, cols = np.nonzero(is_peak)
+    return _suppress_close_peaks(y, rows, cols + 1, min_dist)
+
+
+def detect_peaks_batch(y, thres=0.3, min_dist=3):
+    """
+    Peak detection of several waveforms at once, see detect_peaks.
+
+    Parameters
+    ----------
+    y : ndarray
+        2D waveforms (n_pulses, n_bins).
+    thres : float between [0., 1.]
+        Normalized threshold, relative to the amplitude range of each waveform.
+    min_dist : int
+        Minimum distance between peaks, the highest is kept.
+
+    Returns
+    -------
+    (ndarray, ndarray)
+        CSR-style peak offsets (n_pulses+1) and bin indices: peaks of waveform i are
+        indices[offsets[i]:offsets[i+1]], the same as detect_peaks(y[i], thres, min_dist).
+    """
+    y = np.asarray(y)
+    thres = thres * (np.max(y, axis=1, keepdims=True) - np.min(y, axis=1, keepdims=True))
+    dy = np.diff(y, axis=1)
+    zeros = np.zeros((y.shape[0], 1))
+    is_peak = (np.hstack([dy, zeros]) < 0.) & (np.hstack([zeros, dy]) > 0.) & (y > thres)
+    rows, cols = np.nonzero(is_peak)
+    return _suppress_close_peaks(y, rows, cols, min_dist)
+
+
+def _gaussian_sum(x, par):
+    """
+    Sum of gaussians amplitude / (sigma*sqrt(2*pi)) * exp(-(x-center)^2/(2*sigma^2)), and its jacobian.
+
+    Parameters
+    ----------
+    x : ndarray
+        Abscissa (n_bins).
+    par : ndarray
+        Gaussian parameters (amplitude, center, sigma) of shape (n_pulses, n_gaussians, 3).
+
+    Returns
+    -------
+    (ndarray, ndarray)
+        Sums (n_pulses, n_bins) and jacobian (n_pulses, n_bins, n_gaussians, 3).
+    """
+    amp, cen, wid = [par[:, None, :, k] for k in range(3)]
+    d = x[None, :, None] - cen
+    g = np.exp(-d ** 2 / (2 * wid ** 2)) / (np.sqrt(2 * np.pi) * wid)
+    f = amp * g
+    jac = np.stack([g, f * d / wid ** 2, f * (d ** 2 / wid ** 3 - 1 / wid)], axis=-1)
+    return f.sum(axis=-1), jac
+
+
+def _fit_gaussians(x, y, par, lower, upper, max_iter=200, tol=1e-10):
+    """
+    Bounded Levenberg-Marquardt least squares fit of sums of gaussians to several waveforms at once.
+
+    Parameters
+    ----------
+    x : ndarray
+        Abscissa (n_bins).
+    y : ndarray
+        Waveforms (n_pulses, n_bins).
+    par, lower, upper : ndarray
+        Initial parameters and their bounds, of shape (n_pulses, n_gaussians, 3), see _gaussian_sum.
+    max_iter : int
+        Maximum number of iterations.
+    tol : float
+        Relative decrease of the sum of squares or relative step under which a fit has converged.
+
+    Returns
+    -------
+    ndarray
+        Fitted parameters of shape (n_pulses, n_gaussians, 3).
+    """
+    npulses, ngauss = par.shape[:2]
+    npar = 3 * ngauss
+    par = np.clip(par, lower, upper)
+    model, jac = _gaussian_sum(x, par)
+    res = y - model
+    cost = (res ** 2).sum(axis=1)
+    lam = np.full(npulses, 1e-3)
+    active = cost > 0
+    with np.errstate(all='ignore'):
+        for it in range(max_iter):
+            ia = np.flatnonzero(active)
+            if ia.size == 0:
+                break
+            J = jac[ia].reshape(ia.size, -1, npar)
+            JTJ = np.einsum('inp,inq->ipq', J, J)
+            grad = np.einsum('inp,in->ip', J, res[ia])
+            diag = np.einsum('ipp->ip', JTJ)
+            damping = lam[ia, None] * np.maximum(diag, 1e-12 * diag.max(axis=1, keepdims=True) + 1e-300)
+            A = JTJ + damping[:, :, None] * np.eye(npar)
+            step = np.linalg.solve(A, grad[:, :, None])[:, :, 0].reshape(ia.size, ngauss, 3)
+            new_par = np.clip(par[ia] + step, lower[ia], upper[ia])
+            new_model, new_jac = _gaussian_sum(x, new_par)
+            new_res = y[ia] - new_model
+            new_cost = (new_res ** 2).sum(axis=1)
+
+            better = new_cost < cost[ia]
+            ib = ia[better]
+            rel_decrease = (cost[ib] - new_cost[better]) / cost[ib]
+            rel_step = np.abs(new_par[better] - par[ib]).reshape(ib.size, npar).max(axis=1) / \
+                       (np.abs(par[ib]).reshape(ib.size, npar).max(axis=1) + tol)
+            par[ib] = new_par[better]
+            jac[ib] = new_jac[better]
+            res[ib] = new_res[better]
+            cost[ib] = new_cost[better]
+            lam[ib] /= 10
+            active[ib[(rel_decrease < tol) | (rel_step < tol) | (new_cost[better] == 0)]] = False
+
+            iw = ia[~better]
+            lam[iw] *= 10
+            active[iw[lam[iw] > 1e16]] = False
+    return par
+
+
+def gaussian_decomposition_batch(y, thres=0.005, min_dist=3, max_iter=200, batch_size=1000):
+    """
+    Gaussian decomposition of several waveforms at once, with numpy only.
+
+    It follows the algorithm of gdecomp.GaussianDecomposition: zero crossing peaks higher than thres
+    are seeded with the interval of monotonic decrease around them, and the sum of gaussians is fitted
+    with bounded Levenberg-Marquardt iterations (amplitude >= 0, center within the interval, sigma > 0).
+    Waveforms with the same number of peaks are fitted together, by batches of batch_size waveforms.
+
+    Parameters
+    ----------
+    y : ndarray
+        2D waveforms (n_pulses, n_bins).
+    thres : float
+        Threshold underwhich peak is not considered as an echo.
+    min_dist : int
+        Minimum distance between peaks, the highest is kept.
+    max_iter : int
+        Maximum number of Levenberg-Marquardt iterations.
+    batch_size : int
+        Maximum number of waveforms fitted at once, bounding memory.
+
+    Returns
+    -------
+    list
+        For each waveform, array of length 3*number_peaks of form
+        [amplitude_0, mu_0, sigma_0, amplitude_1, mu_1, sigma_1, ...], as gdecomp.GaussianDecomposition.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> x = np.arange(40)
+    >>> y = 100 * np.exp(-(x - 10.3) ** 2 / 8) + 50 * np.exp(-(x - 25) ** 2 / 2)
+    >>> out = gaussian_decomposition_batch(np.vstack([y, np.zeros(40)]), 5, 3)
+    >>> np.round(out[0].reshape(-1, 3), 3)
+    array([[501.326,  10.3  ,   2.   ],
+           [125.331,  25.   ,   1.   ]])
+    >>> out[1]
+    array([], dtype=float64)
+    """
+    y = np.asarray(y, dtype=float)
+    npulses, nbins = y.shape
+    x = np.arange(nbins, dtype=float)
+
+    # peaks, see gdecomp: peaks on the right are removed up to min_dist+1
+    offsets, peaks = findZeroCrossingPeaksBatch(y, thres, 1)
+    counts = np.diff(offsets)
+    rows = np.repeat(np.arange(npulses), counts)
+    if min_dist > 1:
+        multi = counts[rows] > 1
+        kept_offsets, kept_peaks = _suppress_close_peaks(y, rows[multi], peaks[multi], min_dist, min_dist + 1)
+        kept_counts = np.diff(kept_offsets)
+        single = ~multi
+        counts = np.where(counts > 1, kept_counts, counts)
+        rows = np.concatenate([rows[single], np.repeat(np.arange(npulses), kept_counts)])
+        peaks = np.concatenate([peaks[single], kept_peaks])
+        order = np.lexsort((peaks, rows))
+        rows, peaks = rows[order], peaks[order]
+
+    # intervals of monotonic decrease around peaks, stopping at zeros
+    idx = np.arange(nbins)
+    left_stop = np.ones_like(y, dtype=bool)
+    left_stop[:, 1:] = ~((y[:, :-1] <= y[:, 1:]) & (y[:, :-1] != 0))
+    left = np.maximum.accumulate(np.where(left_stop, idx, 0), axis=1)
+    right_stop = np.ones_like(y, dtype=bool)
+    right_stop[:, :-1] = ~((y[:, 1:] <= y[:, :-1]) & (y[:, 1:] != 0))
+    right = np.minimum.accumulate(np.where(right_stop, idx, nbins - 1)[:, ::-1], axis=1)[:, ::-1]
+    li = left[rows, peaks]
+    ri = right[rows, peaks]
+
+    # initial parameters guessed on [li, ri), see gdecomp
+    ri_guess = np.maximum(ri, li + 1)
+    in_interval = (idx >= li[:, None]) & (idx < ri_guess[:, None])
+    sub_y = y[rows]
+    maxy = np.where(in_interval, sub_y, -np.inf).max(axis=1)
+    miny = np.where(in_interval, sub_y, np.inf).min(axis=1)
+    cen = np.argmax(np.where(in_interval, sub_y, -np.inf), axis=1).astype(float)
+    wid = np.maximum(ri_guess - 1 - li, 1) / 6.0
+    amp = (maxy - miny) * 3.0 * wid
+    par0 = np.stack([amp, cen, wid], axis=-1)
+    lower0 = np.stack([np.zeros_like(amp), li.astype(float), np.full_like(amp, 1e-6)], axis=-1)
+    upper0 = np.stack([np.full_like(amp, np.inf), ri.astype(float), np.full_like(amp, np.inf)], axis=-1)
+
+    outs = [np.zeros(0) for i in range(npulses)]
+    starts = np.cumsum(counts) - counts
+    for ngauss in np.unique(counts[counts > 0]):
+        prows = np.flatnonzero(counts == ngauss)
+        for b in range(0, len(prows), batch_size):
+            brows = prows[b:b + batch_size]
+            sel = (starts[brows, None] + np.arange(ngauss)).ravel()
+            shape = (len(brows), ngauss, 3)
+            par = _fit_gaussians(x, y[brows], par0[sel].reshape(shape),
+                                 lower0[sel].reshape(shape), upper0[sel].reshape(shape), max_iter)
+            for i, p in zip(brows, par):
+                outs[i] = p.ravel()
+    return outs
+
+
 def remove_duplicate(y):
     for i in range(1, len(y)):
         if y[i] == y[i-1]:
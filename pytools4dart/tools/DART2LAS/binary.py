@@ -0,0 +1,623 @@
+# -*- coding: utf-8 -*-
+# ===============================================================================
+# PROGRAMMERS:
+#
+# Florian de Boissieu <fdeboiss@gmail.com>
+# https://gitlab.com/pytools4dart/pytools4dart
+#
+# COPYRIGHT:
+#
+# Copyright 2018-2019 Florian de Boissieu
+#
+# This file is part of the pytools4dart package.
+#
+# pytools4dart is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>
+#
+#
+# ===============================================================================
+"""
+This module contains tools to decode DART lidar binary file LIDAR_IMAGE_FILE.binary
+with numpy, i.e. reading pulses as records of a structured array instead of
+unpacking them one by one.
+"""
+
+import struct
+import json
+import hashlib
+import warnings
+import numpy as np
+from path import Path
+
+hearder_length = 90  # 50+12+28
+waveform_parameter_length = 104
+
+hearder_format = "=50s2I4?2d3I"
+waveform_parameter_format = "=11d4I"
+
+# Pulse parameters, in the order of waveform_parameter_format
+pulse_parameter_fields = [
+    ('look_angle', 'f8'),  # Look angle (in rad) (from -pi/2 (left) to pi/2 (right))
+    ('theta', 'f8'),  # Incident angles: theta, phi (in rad)
+    ('phi', 'f8'),
+    ('dir_x', 'f8'),  # Incident unit distance: x, y, z (in meter)
+    ('dir_y', 'f8'),
+    ('dir_z', 'f8'),
+    ('platform_x', 'f8'),  # Platform position: x, y, z (in meter)
+    ('platform_y', 'f8'),
+    ('platform_z', 'f8'),
+    ('time_convolved', 'f8'),  # Beginning time of the convolved waveform
+    ('time_non_convolved', 'f8'),  # Beginning time of the non-convolved waveform
+    ('nb_bins_to_center', 'u4'),  # Number of bins from sensor to center of FOV
+    ('index_x', 'u4'),  # not documented in DART User Manual, seems to be pulse grid indices
+    ('index_y', 'u4'),
+    ('pulse_id', 'u4'),  # seems to be the pulse ID (0-based)
+]
+
+
+def read_header(dartFileName):
+    """
+    Read the header of a DART lidar binary file.
+
+    Parameters
+    ----------
+    dartFileName: str
+        Path to LIDAR_IMAGE_FILE.binary
+
+    Returns
+    -------
+    dict
+        Header values, with the number of bytes between the end of
+        a convolved waveform and the next pulse in 'offset_per_pulse'.
+    """
+    with open(dartFileName, 'rb') as f:
+        hearder_record = f.read(hearder_length)
+    if len(hearder_record) < hearder_length:
+        raise IOError("Reading failed on input DART file " + str(dartFileName))
+
+    header_data = struct.unpack(hearder_format, hearder_record)
+
+    header = {'version': header_data[0],
+              'float': header_data[3],
+              'non_convolved': header_data[4],
+              'first_order': header_data[5],
+              'stats': header_data[6],
+              'time_step': header_data[7],  # in ns
+              'dist_step': header_data[8],
+              'nb_bins_convolved': header_data[9],
+              'nb_bins_non_convolved': header_data[10],
+              'nb_pulses': header_data[11]}
+
+    # Calculate the offset of waveforms between pulses
+    nbBytes = 4 if header['float'] else 8
+    posOffsetPerPulse = 0
+    if header['stats']:
+        posOffsetPerPulse += 9 + 41 * nbBytes - 1
+    if header['non_convolved']:
+        if header['first_order']:
+            posOffsetPerPulse += nbBytes * (2 * header['nb_bins_non_convolved'] + header['nb_bins_convolved'])
+        else:
+            posOffsetPerPulse += nbBytes * header['nb_bins_non_convolved']
+    else:
+        if header['first_order']:
+            posOffsetPerPulse += nbBytes * header['nb_bins_convolved']
+
+    header['offset_per_pulse'] = posOffsetPerPulse
+
+    return header
+
+
+def pulse_dtype(header):
+    """
+    Numpy structured dtype of a pulse record: parameters, convolved waveform
+    and the remaining data (non-convolved waveforms, statistics) left undecoded.
+
+    Parameters
+    ----------
+    header: dict
+        Header as returned by read_header.
+
+    Returns
+    -------
+    numpy.dtype
+    """
+    fields = list(pulse_parameter_fields)
+    wave_type = 'f4' if header['float'] else 'f8'
+    fields.append(('waveform', wave_type, (header['nb_bins_convolved'],)))
+    if header['offset_per_pulse'] > 0:
+        fields.append(('trailer', 'V{}'.format(header['offset_per_pulse'])))
+    dtype = np.dtype(fields)
+    assert dtype.fields['waveform'][1] == waveform_parameter_length
+    return dtype
+
+
+def read_pulses(dartFileName, header=None):
+    """
+    Memory map the pulses of a DART lidar binary file.
+
+    Parameters
+    ----------
+    dartFileName: str
+        Path to LIDAR_IMAGE_FILE.binary
+    header: dict
+        Header as returned by read_header. If None, it is read from dartFileName.
+
+    Returns
+    -------
+    numpy.memmap
+        Structured array of nb_pulses records, see pulse_dtype.
+
+    Examples
+    --------
+    >>> from pytools4dart.tools.DART2LAS.binary import read_pulses
+    >>> pulses = read_pulses('LIDAR_IMAGE_FILE.binary') # doctest: +SKIP
+    >>> pulses['waveform'].shape # doctest: +SKIP
+    (nb_pulses, nb_bins_convolved)
+    """
+    if header is None:
+        header = read_header(dartFileName)
+    dtype = pulse_dtype(header)
+    expected_size = hearder_length + dtype.itemsize * header['nb_pulses']
+    if Path(dartFileName).size < expected_size:
+        raise IOError('DART file {} is shorter than expected from its header: {} < {} bytes'.format(
+            dartFileName, Path(dartFileName).size, expected_size))
+    if header['nb_pulses'] == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(dartFileName, dtype=dtype, mode='r', offset=hearder_length,
+                     shape=(header['nb_pulses'],))
+
+
+def iter_pulse_chunks(pulses, chunk_size):
+    """
+    Iterate over pulses by chunks loaded in memory.
+
+    Parameters
+    ----------
+    pulses: numpy.ndarray
+        Structured array of pulses, see read_pulses.
+    chunk_size: int
+        Number of pulses per chunk
+
+    Returns
+    -------
+    generator
+        (start, chunk) with start the index of the first pulse of chunk.
+    """
+    for start in range(0, len(pulses), chunk_size):
+        yield start, np.array(pulses[start:start + chunk_size])
+
+
+def waveform_max(dartFileName, pulses=None, chunk_size=10000, cache=True):
+    """
+    Maximum value of the convolved waveforms of a DART lidar binary file.
+
+    Parameters
+    ----------
+    dartFileName: str
+        Path to LIDAR_IMAGE_FILE.binary
+    pulses: numpy.ndarray
+        Pulses of dartFileName as returned by read_pulses, e.g. to reuse an existing memory map.
+        If None, dartFileName is memory mapped.
+    chunk_size: int
+        Number of pulses reduced at once.
+    cache: bool
+        If True, the maximum is saved to sidecar file '<dartFileName>.wavemax',
+        and read from it as long as the size and the modification time of dartFileName are unchanged.
+
+    Returns
+    -------
+    float
+        Maximum of waveforms, -1 if there is no pulse.
+    """
+    dartFileName = Path(dartFileName)
+    cacheFile = Path(dartFileName + '.wavemax')
+    stat = dartFileName.stat()
+    key = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    if cache and cacheFile.is_file():
+        try:
+            with open(cacheFile, 'r') as f:
+                cached = json.load(f)
+            if all(cached.get(k) == v for k, v in key.items()):
+                return cached['max']
+        except (ValueError, KeyError):
+            pass
+
+    if pulses is None:
+        pulses = read_pulses(dartFileName)
+
+    waveMax = -1.
+    waves = pulses['waveform']
+    for start in range(0, len(waves), chunk_size):
+        waveMax = max(waveMax, float(waves[start:start + chunk_size].max()))
+
+    if cache:
+        key['max'] = waveMax
+        try:
+            with open(cacheFile, 'w') as f:
+                json.dump(key, f)
+        except OSError:
+            warnings.warn('Could not write waveform maximum cache file: {}'.format(cacheFile))
+
+    return waveMax
+
+
+def content_hash(dartFileName, block_size=2**24):
+    """
+    SHA1 hash of a file content.
+
+    Parameters
+    ----------
+    dartFileName: str
+        Path to LIDAR_IMAGE_FILE.binary
+    block_size: int
+        Number of bytes read at once.
+
+    Returns
+    -------
+    str
+        Hexadecimal digest
+    """
+    h = hashlib.sha1()
+    with open(dartFileName, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class LidarBinary(object):
+    """
+    Lazy random access to the pulses of a DART lidar binary file.
+
+    The header is read once, pulses are memory mapped: pulse i is at byte offset
+    hearder_length + i * pulse record size, see pulse_dtype.
+
+    Parameters
+    ----------
+    dartFileName: str
+        Path to LIDAR_IMAGE_FILE.binary
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> from path import Path
+    >>> from pytools4dart.tools.DART2LAS.binary import write_synthetic_binary, LidarBinary
+    >>> dartFileName = Path(tempfile.mkdtemp()) / 'LIDAR_IMAGE_FILE.binary'
+    >>> _ = write_synthetic_binary(dartFileName, nb_pulses=100, nb_bins=50)
+    >>> lb = LidarBinary(dartFileName)
+    >>> len(lb)
+    100
+    >>> lb[10]['pulse_id']
+    np.uint32(10)
+    >>> lb[10:20]['waveform'].shape
+    (10, 50)
+    >>> lb.select(0, 0, 2, 2).tolist()
+    [0, 1, 10, 11]
+    """
+
+    def __init__(self, dartFileName):
+        self.filename = Path(dartFileName)
+        self.header = read_header(self.filename)
+        self.dtype = pulse_dtype(self.header)
+        self._pulses = None
+        self._xy = {}
+
+    def __len__(self):
+        return self.header['nb_pulses']
+
+    def __getitem__(self, key):
+        """
+        Pulses records: a numpy.void for an integer, a view on the memory map for a slice,
+        and a copy of the selected pulses for an index array or a boolean mask.
+        """
+        return self.pulses[key]
+
+    def __repr__(self):
+        return "{}('{}'): {} pulses of {} bins".format(type(self).__name__, self.filename, len(self),
+                                                   self.header['nb_bins_convolved'])
+
+    @property
+    def pulses(self):
+        """numpy.memmap: pulses records, see read_pulses. Mapped at first access."""
+        if self._pulses is None:
+            self._pulses = read_pulses(self.filename, self.header)
+        return self._pulses
+
+    def offset(self, index):
+        """
+        Byte offset of pulses in the file.
+
+        Parameters
+        ----------
+        index: int or numpy.ndarray
+            Pulse index.
+
+        Returns
+        -------
+        int or numpy.ndarray
+        """
+        return hearder_length + np.asarray(index, dtype=np.int64) * self.dtype.itemsize
+
+    def xy(self, target=False, chunk_size=100000):
+        """
+        Horizontal position of pulses, computed once by chunks of pulses and kept in memory.
+
+        Parameters
+        ----------
+        target: bool
+            If False, position of the platform, otherwise position of the center of the field of view
+            of the pulse, i.e. platform + direction * nb_bins_to_center * dist_step / 2.
+        chunk_size: int
+            Number of pulses read at once.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (nb_pulses, 2).
+        """
+        if target not in self._xy:
+            xy = np.zeros((len(self), 2))
+            for start in range(0, len(self), chunk_size):
+                chunk = self.pulses[start:start + chunk_size]
+                xy[start:start + len(chunk), 0] = chunk['platform_x']
+                xy[start:start + len(chunk), 1] = chunk['platform_y']
+                if target:
+                    dist = chunk['nb_bins_to_center'] * self.header['dist_step'] / 2
+                    xy[start:start + len(chunk), 0] += chunk['dir_x'] * dist
+                    xy[start:start + len(chunk), 1] += chunk['dir_y'] * dist
+            self._xy[target] = xy
+        return self._xy[target]
+
+    def select(self, xmin, ymin, xmax, ymax, target=False):
+        """
+        Index of the pulses within a bounding box (bounds included).
+
+        Parameters
+        ----------
+        xmin, ymin, xmax, ymax: float
+            Bounding box.
+        target: bool
+            Select on the position of the platform (False) or of the field of view center (True), see xy.
+
+        Returns
+        -------
+        numpy.ndarray
+            Pulse index, increasing.
+        """
+        xy = self.xy(target)
+        return np.flatnonzero((xy[:, 0] >= xmin) & (xy[:, 0] <= xmax) &
+                              (xy[:, 1] >= ymin) & (xy[:, 1] <= ymax))
+
+    def write(self, dartFileName, index, chunk_size=10000):
+        """
+        Write a subset of pulses to a new DART lidar binary file,
+        e.g. to convert only a part of the pulses with DART2LAS.
+
+        Parameters
+        ----------
+        dartFileName: str
+            Path to the file to write.
+        index: numpy.ndarray
+            Index or boolean mask of the pulses to write.
+        chunk_size: int
+            Number of pulses copied at once.
+        """
+        index = np.arange(len(self))[index]
+        with open(self.filename, 'rb') as f:
+            header_data = list(struct.unpack(hearder_format, f.read(hearder_length)))
+        header_data[-1] = len(index)
+        with open(dartFileName, 'wb') as f:
+            f.write(struct.pack(hearder_format, *header_data))
+            for start in range(0, len(index), chunk_size):
+                self.pulses[index[start:start + chunk_size]].tofile(f)
+
+    def close(self):
+        """Close the memory map."""
+        self._pulses = None
+
+
+def export_pulses(dartFileName, outFile, fmt=None, fields=None, chunk_size=10000, compression=False):
+    """
+    Export pulse parameters and convolved waveforms of a DART lidar binary file to an array store,
+    one array per field, written by chunks of pulses.
+
+    Parameters
+    ----------
+    dartFileName: str
+        Path to LIDAR_IMAGE_FILE.binary
+    outFile: str
+        Path of the store: a directory of .npy files, a .zarr directory or a .h5 file.
+    fmt: str
+        Store format, either 'npy', 'zarr' or 'hdf5'. If None, it is guessed from outFile extension
+        ('.zarr', '.h5' or '.hdf5', 'npy' otherwise).
+    fields: list
+        Fields to export, see pulse_parameter_fields, and 'waveform'. If None, all are exported.
+    chunk_size: int
+        Number of pulses per chunk of store, and read at once.
+    compression: bool or str
+        Compression of zarr and hdf5 stores: False for no compression, True for the default compressor
+        of zarr or gzip for hdf5, or the name of an hdf5 filter (e.g. 'lzf').
+        Not available for npy.
+
+    Returns
+    -------
+    str
+        outFile
+
+    Notes
+    -----
+    Header values are saved in file header.json of npy store, or as attributes of zarr and hdf5 stores.
+    Stores can be read lazily, e.g. numpy.load(outFile / 'waveform.npy', mmap_mode='r'),
+    zarr.open(outFile)['waveform'] or h5py.File(outFile)['waveform'].
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> from pytools4dart.tools.DART2LAS.binary import export_pulses
+    >>> export_pulses('LIDAR_IMAGE_FILE.binary', 'pulses') # doctest: +SKIP
+    >>> waveforms = np.load('pulses/waveform.npy', mmap_mode='r') # doctest: +SKIP
+    """
+    outFile = Path(outFile)
+    if fmt is None:
+        fmt = {'.zarr': 'zarr', '.h5': 'hdf5', '.hdf5': 'hdf5'}.get(outFile.suffix.lower(), 'npy')
+
+    header = read_header(dartFileName)
+    pulses = read_pulses(dartFileName, header)
+    if fields is None:
+        fields = [name for name, _ in pulse_parameter_fields] + ['waveform']
+    attrs = dict(header, version=header['version'].rstrip(b'\x00').decode(errors='replace'))
+
+    if fmt == 'npy':
+        if compression:
+            raise ValueError('Compression is not available for npy format.')
+        outFile.makedirs_p()
+        with open(outFile / 'header.json', 'w') as f:
+            json.dump(attrs, f)
+        arrays = {field: np.lib.format.open_memmap(outFile / (field + '.npy'), mode='w+',
+                                                   dtype=pulses.dtype[field].base,
+                                                   shape=(len(pulses),) + pulses.dtype[field].shape)
+                  for field in fields}
+    elif fmt == 'zarr':
+        import zarr
+        store = zarr.open_group(outFile, mode='w')
+        store.attrs.update(attrs)
+        if int(zarr.__version__.split('.')[0]) >= 3:
+            compressor = {} if compression else {'compressors': None}
+            create = store.create_array
+        else:
+            compressor = {} if compression else {'compressor': None}
+            create = store.create_dataset
+        arrays = {field: create(field, shape=(len(pulses),) + pulses.dtype[field].shape,
+                                chunks=(chunk_size,) + pulses.dtype[field].shape,
+                                dtype=pulses.dtype[field].base, **compressor)
+                  for field in fields}
+    elif fmt == 'hdf5':
+        import h5py
+        if compression is True:
+            compression = 'gzip'
+        store = h5py.File(outFile, 'w')
+        store.attrs.update(attrs)
+        arrays = {field: store.create_dataset(field, shape=(len(pulses),) + pulses.dtype[field].shape,
+                                              chunks=(max(min(chunk_size, len(pulses)), 1),) + pulses.dtype[field].shape,
+                                              dtype=pulses.dtype[field].base, compression=compression or None)
+                  for field in fields}
+    else:
+        raise ValueError("Unknown format '{}', expected 'npy', 'zarr' or 'hdf5'.".format(fmt))
+
+    try:
+        for start, chunk in iter_pulse_chunks(pulses, chunk_size):
+            for field in fields:
+                arrays[field][start:start + len(chunk)] = chunk[field]
+    finally:
+        if fmt == 'npy':
+            for array in arrays.values():
+                array.flush()
+        elif fmt == 'hdf5':
+            store.close()
+
+    return outFile
+
+
+def write_synthetic_binary(dartFileName, nb_pulses=1000, nb_bins=500, use_float=True, nb_echoes=3,
+                           stats=False, seed=None):
+    """
+    Write a synthetic DART lidar binary file, e.g. to test or benchmark conversion without DART.
+
+    Pulses are nadir, on a regular grid of 1 m spacing at 1000 m height.
+    Their convolved waveforms are sums of nb_echoes gaussians
+    of random amplitude (in [0.1, 1[), center and width (in [1, 3] bins),
+    the centers being separated by nb_bins/(nb_echoes+1) bins on average.
+    All echoes are detected by DART2LAS with default gain and noise threshold.
+
+    Parameters
+    ----------
+    dartFileName: str
+        Path to the file to write.
+    nb_pulses: int
+        Number of pulses.
+    nb_bins: int
+        Number of bins of the convolved waveforms.
+    use_float: bool
+        If True, waveforms are written in single precision, otherwise in double precision.
+    nb_echoes: int
+        Number of gaussian echoes per waveform.
+    stats: bool
+        If True, (zero) statistics are written after each waveform.
+    seed: int
+        Seed of the random generator.
+
+    Returns
+    -------
+    dict
+        Header of the file, see read_header.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> from path import Path
+    >>> from pytools4dart.tools.DART2LAS.binary import write_synthetic_binary, read_pulses
+    >>> dartFileName = Path(tempfile.mkdtemp()) / 'LIDAR_IMAGE_FILE.binary'
+    >>> header = write_synthetic_binary(dartFileName, nb_pulses=10, nb_bins=100)
+    >>> read_pulses(dartFileName)['waveform'].shape
+    (10, 100)
+    """
+    rng = np.random.default_rng(seed)
+    time_step = 1.  # ns
+    dist_step = 0.299792458 * time_step  # distance travelled by light in time_step, in m
+    height = 1000.
+
+    nbBytes = 4 if use_float else 8
+    header = {'version': b'DART synthetic lidar binary file',
+              'float': use_float,
+              'non_convolved': False,
+              'first_order': False,
+              'stats': stats,
+              'time_step': time_step,
+              'dist_step': dist_step,
+              'nb_bins_convolved': nb_bins,
+              'nb_bins_non_convolved': 0,
+              'nb_pulses': nb_pulses,
+              'offset_per_pulse': 9 + 41 * nbBytes - 1 if stats else 0}
+
+    pulses = np.zeros(nb_pulses, dtype=pulse_dtype(header))
+    side = int(np.ceil(np.sqrt(nb_pulses)))
+    pulse_id = np.arange(nb_pulses)
+    pulses['dir_z'] = -1.
+    pulses['platform_x'] = pulse_id % side + .5
+    pulses['platform_y'] = pulse_id // side + .5
+    pulses['platform_z'] = height
+    # waveforms start at the middle of their number of bins before the center of field of view (ground)
+    pulses['nb_bins_to_center'] = int(round(2 * height / dist_step))
+    pulses['time_convolved'] = - nb_bins / 2 * time_step
+    pulses['time_non_convolved'] = pulses['time_convolved']
+    pulses['index_x'] = pulse_id % side
+    pulses['index_y'] = pulse_id // side
+    pulses['pulse_id'] = pulse_id
+
+    bins = np.arange(nb_bins)
+    spacing = nb_bins / (nb_echoes + 1)
+    for e in range(nb_echoes):
+        center = (e + 1) * spacing + rng.uniform(-spacing / 4, spacing / 4, (nb_pulses, 1))
+        sigma = rng.uniform(1, 3, (nb_pulses, 1))
+        amplitude = rng.uniform(.1, 1, (nb_pulses, 1))
+        pulses['waveform'] += amplitude * np.exp(-(bins - center) ** 2 / (2 * sigma ** 2))
+
+    header_record = struct.pack(hearder_format, header['version'], 0, 0,
+                                header['float'], header['non_convolved'], header['first_order'], header['stats'],
+                                header['time_step'], header['dist_step'],
+                                header['nb_bins_convolved'], header['nb_bins_non_convolved'], header['nb_pulses'])
+    with open(dartFileName, 'wb') as f:
+        f.write(header_record)
+        pulses.tofile(f)
+
+    return header
@@ -41,14 +41,22 @@ import pandas as pd
 from path import Path
 import numpy as np
 import geopandas as gpd
+import shapely
 from shapely.geometry import box, Polygon
-from shapely.affinity import affine_transform
 import rasterio
 from rasterio.mask import mask
 from rasterio.transform import Affine
 from rasterio.warp import reproject, Resampling
+from rasterio.windows import Window
 import tempfile
+from multiprocessing import Pool
 from ..warnings import deprecated
+from .constants import PLOTS_HEADER
+try:
+    import pyarrow
+    import pyarrow.csv as pacsv
+except ImportError:  # pandas is used to read .vox files
+    pyarrow = pacsv = None
 
 
 
@@ -69,6 +77,27 @@ class voxel(object):
         self.data = []
         self.grid = []
 
+    @property
+    def grid(self):
+        """
+        geopandas.GeoDataFrame
+            Grid cells with indices i, j and polygon geometry.
+            It is created at first access, and affine transformations applied in place
+            are composed and applied to the geometries only when the grid is accessed.
+        """
+        if self._grid is None:
+            self._grid = self._build_grid()
+        if len(self._grid_transforms) > 0:
+            matrix = _compose_transforms(self._grid_transforms)
+            self._grid.geometry = _affine_transform(self._grid.geometry.values, matrix)
+            self._grid_transforms = []
+        return self._grid
+
+    @grid.setter
+    def grid(self, grid):
+        self._grid = grid
+        self._grid_transforms = []
+
     @property
     def extent(self):
         """
@@ -82,7 +111,8 @@ class voxel(object):
         return self.grid.total_bounds
 
     @classmethod
-    def from_vox(cls, filename):
+    def from_vox(cls, filename, columns=None, compact=False, engine='pandas', cache=None, sparse=False,
+                 chunk_size=1000000):
         """
         Load an AMAPVox file.
 
@@ -90,6 +120,26 @@ class voxel(object):
         ----------
         filename: str
             Path to an AMAPVox .vox file
+        columns: list
+            Columns to load, e.g. ['pad', 'angleMean']. Indices i, j, k are always loaded.
+            If None, all columns are loaded.
+        compact: bool
+            If True, indices are loaded as int16 (int32 for grids larger than 32767 cells)
+            and other columns as float32, dividing memory by 2 to 4.
+        engine: str
+            CSV parser, either 'pandas' or 'pyarrow' (multi-threaded, requires package pyarrow).
+        cache: str
+            Binary sidecar file format, either 'parquet' or 'feather' (requires package pyarrow).
+            Data is saved in `<filename>.<cache>` at first load and read from it at later loads,
+            as long as the .vox file is unchanged (same size and modification time).
+            If None, no sidecar file is used.
+        sparse: bool
+            If True, empty voxels (pad equal to 0 or NaN) are dropped while reading the file by chunks,
+            so that memory scales with the number of occupied voxels. Grid and header keep the full voxel space.
+            The file must have column PadBVTotal, which is returned as pad only if in columns.
+            With engine 'pyarrow', columns other than indices are read as float.
+        chunk_size: int
+            Approximate number of voxels read at once when sparse is True.
 
         Returns
         -------
@@ -99,15 +149,30 @@ class voxel(object):
         # Load the example voxel file
         >>> import pytools4dart as ptd
         >>> from path import Path
-        >>> voxfile = Path(ptd.__file__) / 'data' /'forest.vox'
+        >>> voxfile = Path(ptd.__file__).parent / 'data' / 'forest.vox'
         >>> vox = ptd.voxreader.voxel.from_vox(voxfile)
 
+        # Load only occupied voxels
+        >>> vox = ptd.voxreader.voxel.from_vox(voxfile, sparse=True)
+        >>> len(vox.data)
+        4890
+
+        # Load only plant area density with compact types, and cache it for next loads
+        # in file forest.vox.parquet next to a copy of the voxel file
+        >>> import shutil, tempfile
+        >>> tmpfile = Path(tempfile.mkdtemp()) / 'forest.vox'
+        >>> _ = shutil.copy(voxfile, tmpfile)
+        >>> vox = ptd.voxreader.voxel.from_vox(tmpfile, columns=['pad'], compact=True, cache='parquet')
+        >>> (tmpfile + '.parquet').exists()
+        True
+
         # See use-case 3 for a simulation case
         """
         newVoxel = cls()
         newVoxel.inputfile = Path(filename).expanduser()
         newVoxel._read_vox_header()  # description de la scène voxelisées
-        newVoxel._read_vox_data()  # description de chaque voxel
+        newVoxel._read_vox_data(columns=columns, compact=compact, engine=engine, cache=cache,
+                                sparse=sparse, chunk_size=chunk_size)  # description de chaque voxel
         newVoxel._create_grid()
         return (newVoxel)
 
@@ -166,6 +231,64 @@ class voxel(object):
         newVoxel._create_grid()
         return (newVoxel)
 
+    @classmethod
+    def from_cube(cls, cube, min_corner=[0., 0., 0.], res=[1.], lad='Spherical', pad_max='NA', sparse=False):
+        """
+        Create a voxel object from dense 3D arrays, see voxel.to_cube.
+
+        Parameters
+        ----------
+        cube: numpy.ndarray or dict
+            Plant area density array indexed [k, j, i],
+            or dict of arrays indexed [k, j, i] with at least key 'pad'.
+        min_corner:
+            coordinates of minimum corner
+        res:
+            resolution
+        lad: str
+            leaf angle distribution
+        pad_max:
+            Maximum PAD value used in AMAPVox. If not known, it can be left to 'NA'.
+        sparse: bool
+            If True, only voxels with pad different from 0 and NaN are kept in data.
+
+        Examples
+        --------
+        >>> import pytools4dart as ptd
+        >>> import numpy as np
+        >>> cube = np.zeros((4, 3, 2))
+        >>> cube[1, 2, 0] = 1.5
+        >>> vox = ptd.voxreader.voxel.from_cube(cube, sparse=True)
+        >>> vox.data
+           i  j  k  pad
+        0  0  2  1  1.5
+        >>> vox.header['split']
+        [2, 3, 4]
+        """
+        if not isinstance(cube, dict):
+            cube = {'pad': cube}
+        nz, ny, nx = cube['pad'].shape
+
+        # voxels are ordered by i, j then k as in AMAPVox files
+        data = {c: np.asarray(v).transpose(2, 1, 0).ravel() for c, v in cube.items()}
+        i = np.repeat(np.arange(nx), ny * nz)
+        j = np.tile(np.repeat(np.arange(ny), nz), nx)
+        k = np.tile(np.arange(nz), nx * ny)
+        if sparse:
+            keep = (data['pad'] != 0) & ~np.isnan(data['pad'])
+            data = {c: v[keep] for c, v in data.items()}
+            i, j, k = i[keep], j[keep], k[keep]
+
+        newVoxel = cls.from_data(i, j, k, data['pad'], min_corner, res, lad, pad_max)
+        for c, v in data.items():
+            if c != 'pad':
+                newVoxel.data[c] = v
+        # the voxel space is the one of the cube, whatever the empty voxels
+        newVoxel.header['split'] = [nx, ny, nz]
+        newVoxel.header['max_corner'] = np.array(min_corner) + np.array([nx, ny, nz]) * np.array(res)
+        newVoxel._create_grid()
+        return newVoxel
+
     def _read_vox_header(self, skiprows=1):
         """
         read header of .vox file from AMAPVox.
@@ -216,7 +339,8 @@ class voxel(object):
         self.header = header_dict
 
 
-    def _read_vox_data(self, skiprows=1):
+    def _read_vox_data(self, skiprows=1, columns=None, compact=False, engine='pandas', cache=None, sparse=False,
+                       chunk_size=1000000):
         """
         Read data of .vox file from AMAPVox.
         Column 'PadBVTotal' of AMAPVox file is renamed
@@ -227,46 +351,191 @@ class voxel(object):
 
         skiprows: int
             number of rows to skip before parameters
+        columns: list
+            columns to read, see voxel.from_vox.
+        compact: bool
+            read with compact types, see voxel.from_vox.
+        engine: str
+            'pandas' or 'pyarrow'
+        cache: str
+            None, 'parquet' or 'feather', see voxel.from_vox.
+        sparse: bool
+            drop empty voxels, see voxel.from_vox.
+        chunk_size: int
+            number of voxels read at once when sparse.
         """
+        if engine not in ['pandas', 'pyarrow']:
+            raise ValueError("engine must be 'pandas' or 'pyarrow'.")
+        if cache not in [None, 'parquet', 'feather']:
+            raise ValueError("cache must be None, 'parquet' or 'feather'.")
+
+        if columns is not None:
+            columns = ['i', 'j', 'k'] + [{'pad': 'PadBVTotal'}.get(c, c) for c in columns if c not in ['i', 'j', 'k']]
+
+        if cache is not None:
+            data = self._read_vox_cache(cache, compact, sparse, columns)
+            if data is None:
+                data = self._read_vox_csv(skiprows, None, compact, engine, sparse, chunk_size)
+                self._write_vox_cache(data, cache, compact, sparse)
+                if columns is not None:
+                    data = data.loc[:, columns]
+        else:
+            data = self._read_vox_csv(skiprows, columns, compact, engine, sparse, chunk_size)
 
-        data = pd.read_csv(self.inputfile, sep=" ", comment="#", skiprows=skiprows)
         if 'PadBVTotal' in data.columns:
             data.rename(columns={'PadBVTotal': 'pad'}, inplace=True)
         self.data = data
 
+    def _vox_columns(self, skiprows=1):
+        """
+        Number of lines before data and column names of .vox file.
+        """
+        with open(self.inputfile, "r") as file:
+            for n, line in enumerate(file):
+                if n >= skiprows and not line.startswith("#"):
+                    return n + 1, line.split()
+
+    def _vox_dtypes(self, columns):
+        """
+        Compact types of .vox columns: int16 or int32 for indices depending on grid size, float32 otherwise.
+        """
+        itype = 'int16' if max(self.header['split']) <= np.iinfo(np.int16).max else 'int32'
+        return {c: itype if c in ['i', 'j', 'k'] else 'float32' for c in columns}
+
+    def _read_vox_csv(self, skiprows=1, columns=None, compact=False, engine='pandas', sparse=False,
+                      chunk_size=1000000):
+        """
+        Read data lines of .vox file, see voxel._read_vox_data.
+        """
+        if sparse:
+            return pd.concat(self._iter_vox_chunks(skiprows, columns, compact, engine, chunk_size),
+                             ignore_index=True)
+
+        nrows, names = self._vox_columns(skiprows)
+        if columns is None:
+            columns = names
+        dtype = self._vox_dtypes(columns) if compact else None
+
+        if engine == 'pyarrow':
+            if pacsv is None:
+                raise ImportError("engine 'pyarrow' requires package pyarrow.")
+            table = pacsv.read_csv(self.inputfile,
+                                   read_options=pacsv.ReadOptions(skip_rows=nrows, column_names=names),
+                                   parse_options=pacsv.ParseOptions(delimiter=' '),
+                                   convert_options=pacsv.ConvertOptions(column_types=dtype, include_columns=columns))
+            return table.to_pandas()
+
+        return pd.read_csv(self.inputfile, sep=" ", comment="#", skiprows=skiprows, usecols=columns,
+                           dtype=dtype).loc[:, columns]
+
+    def _iter_vox_chunks(self, skiprows=1, columns=None, compact=False, engine='pandas', chunk_size=1000000):
+        """
+        Read data lines of .vox file by chunks, dropping empty voxels (pad equal to 0 or NaN).
+        Column 'PadBVTotal' is read to drop empty voxels, but only returned if it is in columns.
+
+        Returns
+        -------
+        generator
+            pandas.DataFrame of about chunk_size lines before empty voxels are dropped.
+        """
+        nrows, names = self._vox_columns(skiprows)
+        if 'PadBVTotal' not in names:
+            raise ValueError("Column 'PadBVTotal' not found in '{}', "
+                             "empty voxels cannot be dropped.".format(self.inputfile))
+        if columns is None:
+            columns = names
+        read_columns = columns if 'PadBVTotal' in columns else columns + ['PadBVTotal']
+        dtype = self._vox_dtypes(read_columns) if compact else None
+
+        if engine == 'pyarrow':
+            if pacsv is None:
+                raise ImportError("engine 'pyarrow' requires package pyarrow.")
+            # types must be known before streaming, as they would be inferred on the first block only
+            if dtype is None:
+                dtype = {c: 'int64' if c in ['i', 'j', 'k'] else 'float64' for c in read_columns}
+            with open(self.inputfile, 'r') as f:
+                sample = ''.join([f.readline() for _ in range(nrows + 100)])
+            line_length = max(len(sample) / max(sample.count('\n'), 1), 1)
+            read_options = pacsv.ReadOptions(skip_rows=nrows, column_names=names,
+                                             block_size=int(chunk_size * line_length))
+            reader = pacsv.open_csv(self.inputfile, read_options=read_options,
+                                    parse_options=pacsv.ParseOptions(delimiter=' '),
+                                    convert_options=pacsv.ConvertOptions(column_types=dtype,
+                                                                         include_columns=read_columns))
+            chunks = (batch.to_pandas() for batch in reader)
+        else:
+            chunks = pd.read_csv(self.inputfile, sep=" ", comment="#", skiprows=skiprows, usecols=read_columns,
+                                 dtype=dtype, chunksize=chunk_size)
+
+        for chunk in chunks:
+            # pad equal to 0 or NaN are empty voxels
+            yield chunk.loc[(chunk['PadBVTotal'] != 0) & pd.notna(chunk['PadBVTotal']), columns]
+
+    def _vox_cache_key(self, compact, sparse):
+        stat = Path(self.inputfile).stat()
+        return '{} {} {} {}'.format(stat.st_size, stat.st_mtime_ns, compact, sparse)
+
+    def _read_vox_cache(self, cache, compact, sparse, columns=None):
+        """
+        Read data from the sidecar file of .vox file, None if missing or out of date.
+        """
+        cache_file = Path(self.inputfile + '.' + cache)
+        if not cache_file.exists():
+            return None
+        if cache == 'parquet':
+            import pyarrow.parquet as pq
+            schema = pq.read_schema(cache_file)
+            if schema.metadata is None or schema.metadata.get(b'vox_key') != self._vox_cache_key(compact, sparse).encode():
+                return None
+            table = pq.read_table(cache_file, columns=columns)
+        else:
+            import pyarrow.feather as feather
+            table = feather.read_table(cache_file, columns=columns, memory_map=True)
+            if table.schema.metadata is None or \
+                    table.schema.metadata.get(b'vox_key') != self._vox_cache_key(compact, sparse).encode():
+                return None
+        return table.to_pandas()
+
+    def _write_vox_cache(self, data, cache, compact, sparse):
+        """
+        Write data to the sidecar file of .vox file, with the key of the .vox file in metadata.
+        """
+        if pyarrow is None:
+            raise ImportError("cache requires package pyarrow.")
+        cache_file = Path(self.inputfile + '.' + cache)
+        table = pyarrow.Table.from_pandas(data, preserve_index=False)
+        table = table.replace_schema_metadata(dict(table.schema.metadata or {},
+                                                   vox_key=self._vox_cache_key(compact, sparse)))
+        if cache == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(table, cache_file)
+        else:
+            import pyarrow.feather as feather
+            feather.write_feather(table, cache_file)
+
     def _create_grid(self):
+        """
+         Resets the grid, that is created at next access of voxel.grid.
+        """
+        self._grid = None
+        self._grid_transforms = []
+
+    def _build_grid(self):
         """
          Creates a geopandas dataframe with one grid cell in each row.
         """
-        polygons = []
-        I = []
-        J = []
-        for i in range(int(self.header["split"][
-                               0])):  # ici chaque voxel est transformée en grille (coordonnées réelles de la scène
-            for j in range(int(self.header["split"][1])):
-                polygons.append(box(i * self.header["res"][0] + self.header["min_corner"][0],
-                                    # les corners et la résolution (res) dans self.header
-                                    j * self.header["res"][0] + self.header["min_corner"][1],
-                                    (i + 1) * self.header["res"][0] + self.header["min_corner"][0],
-                                    (j + 1) * self.header["res"][0] + self.header["min_corner"][1]))
-                # xmin = i * self.header["res"][0] + self.header["min_corner"][0]
-                # ymin = j * self.header["res"][0] + self.header["min_corner"][1]
-                # xmax = (i + 1) * self.header["res"][0] + self.header["min_corner"][0]
-                # ymax = (j + 1) * self.header["res"][0] + self.header["min_corner"][1]
-                #
-                # import numpy as np
-                # coorners =  []
-                # Polygon(np.array([[0, 1], [1, 1], [1, 0], [0, 0]]))
-                #
-                # polygons.append(Polygon([
-                #                     # les corners et la résolution (res) dans self.header
-                #                     ,
-                #                     ,
-                #                     )
-                I.append(i)
-                J.append(j)
-
-        self.grid = gpd.GeoDataFrame({'i': I, 'j': J, 'geometry': polygons})
+        # cells are ordered by i then j, with corners computed on index arrays
+        # from the corners and the resolution (res) in self.header
+        nx, ny = int(self.header["split"][0]), int(self.header["split"][1])
+        res = self.header["res"][0]
+        I = np.repeat(np.arange(nx), ny)
+        J = np.tile(np.arange(ny), nx)
+        polygons = shapely.box(I * res + self.header["min_corner"][0],
+                               J * res + self.header["min_corner"][1],
+                               (I + 1) * res + self.header["min_corner"][0],
+                               (J + 1) * res + self.header["min_corner"][1])
+
+        return gpd.GeoDataFrame({'i': I, 'j': J, 'geometry': polygons})
 
     def affine_transform(self, matrix, inplace=False):
         """
@@ -324,9 +593,9 @@ class voxel(object):
         if not isinstance(matrix, tuple):
             matrix = tuple(matrix)
 
-        new_geometry = gpd.GeoSeries([affine_transform(s, matrix) for s in self.grid.geometry])
         if inplace:
-            self.grid.geometry = new_geometry
+            # geometries are transformed at next access of grid
+            self._grid_transforms.append(matrix)
             # extent = self.grid.total_bounds
             # self.header['min_corner'][0:2] = extent[0:2]
             # self.header['max_corner'][0:2] = extent[2:4]
@@ -336,10 +605,10 @@ class voxel(object):
                 self.header['transforms'].append(matrix)
         else:
             grid = self.grid.copy()
-            grid.geometry = new_geometry
+            grid.geometry = _affine_transform(grid.geometry.values, matrix)
             return grid
 
-    def intersect(self, x, columns=None, inplace=False):
+    def intersect(self, x, columns=None, inplace=False, window=False):
         """
         Intersection of voxel grid with shapefile or a raster
 
@@ -357,6 +626,10 @@ class voxel(object):
         inplace: bool
             If True adds intersecting ID and attributes to data, or raster bands otherwise returns dataframe.
 
+        window: bool
+            Only used with raster.
+            If True, only the raster window covering the voxels is read, see voxel._intersect_raster.
+
         Examples
         --------
 
@@ -417,14 +690,14 @@ class voxel(object):
             except:
                 try:
                     with rasterio.open(x) as r:
-                        out = self._intersect_raster(r, columns, inplace)
+                        out = self._intersect_raster(r, columns, inplace, window)
                 except:
                     raise IOError('File does not exists or could not recognize format of input file to intersect with.')
 
         elif isinstance(x, gpd.GeoDataFrame):
             out = self._intersect_polygons(x, inplace)
         elif isinstance(x, rasterio.DatasetReader):
-            out = self._intersect_raster(x, columns, inplace)
+            out = self._intersect_raster(x, columns, inplace, window)
         else:
             raise ValueError('Arg. x must be a raster or a shapefile or the path to any of them')
 
@@ -451,27 +724,24 @@ class voxel(object):
         """
         # read shapefile
         # polygons = gpd.read_file(shapefile)
-        grid_spatial_index = self.grid.sindex
-        rows = self.header["split"][0]
-        intersectList = []
-        for polygon in polygons.itertuples():
-            # Select cells matching with polygon
-            possible_matches_index = list(grid_spatial_index.intersection(polygon.geometry.bounds))
-            possible_matches = self.grid.iloc[possible_matches_index]
-            precise_matches = possible_matches[possible_matches.intersects(polygon.geometry)]
-            areas = list(map(lambda r: r.intersection(polygon.geometry).area, precise_matches['geometry']))
-
-            if len(areas) > 0:
-                icell = precise_matches.index
-                irow = list(map(lambda x: x % rows, icell))
-                icol = list(map(lambda x: int(x / rows), icell))
-                intersectList.append(
-                    pd.DataFrame({'cell': icell, 'j': irow,
-                                  'i': icol, 'ID': polygon.Index, 'intersected_area': areas}))
-        intersection = pd.concat(intersectList, axis=0, sort=False)
+        # all pairs of intersecting polygon and cell in one spatial index query
+        ipolygon, icell = self.grid.sindex.query(polygons.geometry.values, predicate='intersects')
+        cells = self.grid.geometry.values[icell]
+        # the intersection of a cell contained in the polygon is the cell itself,
+        # only cells crossing polygon boundaries need geometric intersection
+        ipolygon_in, icell_in = self.grid.sindex.query(polygons.geometry.values, predicate='contains')
+        inside = np.isin(ipolygon * len(self.grid) + icell, ipolygon_in * len(self.grid) + icell_in)
+        areas = shapely.area(cells)
+        areas[~inside] = shapely.area(shapely.intersection(cells[~inside],
+                                                           polygons.geometry.values[ipolygon[~inside]]))
+        # cells are ordered by i then j, see _create_grid
+        cols = int(self.header["split"][1])
+        icell = self.grid.index[icell]
+        intersection = pd.DataFrame({'cell': icell, 'j': icell % cols, 'i': icell // cols,
+                                     'ID': polygons.index[ipolygon], 'intersected_area': areas})
 
         # keep polygon with max area
-        intersect_max = intersection.sort_values('intersected_area', ascending=False).drop_duplicates(['cell'])
+        intersect_max = intersection.loc[intersection.groupby('cell')['intersected_area'].idxmax()]
         intersectDF = pd.merge(intersect_max,
                                polygons, left_on="ID", right_index=True, how='left').drop("geometry", axis=1)
         if inplace:
@@ -479,7 +749,7 @@ class voxel(object):
         else:
             return self.data.merge(intersectDF, on=("i", "j"), how="left", copy=True)
 
-    def _intersect_raster(self, r, columns=None, inplace=False):
+    def _intersect_raster(self, r, columns=None, inplace=False, window=False):
         """
         Intersect raster with voxel grid, returning the value of the pixel nearest to the voxel center.
 
@@ -492,6 +762,9 @@ class voxel(object):
             If None, bands are named band_{i}
         inplace: bool
             If True adds the bands to self.data.
+        window: bool
+            If True, only the raster window covering the voxel centers is read.
+            Otherwise, the raster is cropped and masked with the grid extent.
 
         Returns
         -------
@@ -513,14 +786,6 @@ class voxel(object):
         #
         # return df
 
-        img, transform = rasterio.mask.mask(r, [box(*self.extent)], crop=True)
-        meta = r.meta.copy()
-        meta.update({"height": img.shape[1],
-                     "width": img.shape[2],
-                     "transform": transform})
-
-        Txy2index = np.array(transform.__invert__()).reshape(-1, 3)
-
         # Get origin and resolution of voxel
         vxOrigin = self.header['min_corner'][0]
         vyOrigin = self.header['min_corner'][1]
@@ -529,37 +794,89 @@ class voxel(object):
         # get unique i,j of voxels
         intersectDF = self.data[['i', 'j']].drop_duplicates().reset_index(drop=True)
 
-        intersectDF['xc'] = (intersectDF.i + .5) * vxRes + vxOrigin
-        intersectDF['yc'] = (intersectDF.j + .5) * vyRes + vyOrigin
-
-        # compute img col,row corresponding to voxel center
-        intersectDF = intersectDF.join(
-            np.floor(
-                intersectDF[['xc', 'yc']].dot(Txy2index[0:2, 0:2]).add(Txy2index[0:2, 2]).rename(
-                    columns={0: 'col', 1: 'row'})
-            ).astype(int)
-        )
-
-        # remove negative col,row
-        intersectDF = intersectDF.loc[(intersectDF.row >= 0) & (intersectDF.col >= 0)].reset_index(drop=True)
+        xc = (intersectDF.i.to_numpy() + .5) * vxRes + vxOrigin
+        yc = (intersectDF.j.to_numpy() + .5) * vyRes + vyOrigin
+
+        if window:
+            # img col,row corresponding to voxel center, read only the window covering them
+            col, row = _xy_to_colrow(r.transform, xc, yc)
+            inside = (row >= 0) & (col >= 0) & (row < r.height) & (col < r.width)
+            if inside.any():
+                row_off, col_off = row[inside].min(), col[inside].min()
+                img = r.read(window=Window(col_off, row_off,
+                                           col[inside].max() - col_off + 1, row[inside].max() - row_off + 1))
+                row = row - row_off
+                col = col - col_off
+            else:
+                img = np.empty((r.count, 0, 0), dtype=r.dtypes[0])
+        else:
+            img, transform = rasterio.mask.mask(r, [box(*self.extent)], crop=True)
+            # img col,row corresponding to voxel center
+            col, row = _xy_to_colrow(transform, xc, yc)
+            inside = (row >= 0) & (col >= 0) & (row < img.shape[1]) & (col < img.shape[2])
 
-        # extract corresponding bands
-        bands = []
-        for row in intersectDF.itertuples():
-            bands.append(img[:, row.row, row.col])
+        # remove voxels outside image and extract corresponding bands
+        intersectDF = intersectDF.loc[inside].reset_index(drop=True)
+        bands = img[:, row[inside], col[inside]].T
 
         if columns is None:
             columns = ['band_{}'.format(i) for i in range(img.shape[0])]
 
         df = pd.concat([intersectDF, pd.DataFrame(bands, columns=columns)], axis=1)
 
-        df = df.drop(['xc', 'yc', 'row', 'col'], axis=1)
-
         if inplace:
             self.data = self.data.merge(df, on=['i', 'j'], how='left', copy=False)
         else:
             return self.data.merge(df, on=['i', 'j'], how='left', copy=True)
 
+    def to_cube(self, columns='pad', fill_value=0.):
+        """
+        Convert data columns to dense 3D arrays indexed [k, j, i], covering the whole voxel space.
+
+        Column sums, vertical profiles or aggregations are then numpy reductions along the axes,
+        e.g. cube.sum(axis=0) for the vertical sum of each column of voxels.
+
+        Parameters
+        ----------
+        columns: str or list of str
+            Data columns to convert.
+        fill_value: float
+            Value of the voxels missing in data, e.g. empty voxels dropped with from_vox(sparse=True).
+
+        Returns
+        -------
+        numpy.ndarray or dict
+            The array of columns if a str, a dict of arrays otherwise.
+
+        Examples
+        --------
+        >>> import pytools4dart as ptd
+        >>> import numpy as np
+        >>> from path import Path
+        >>> voxfile = Path(ptd.__file__).parent / 'data' / 'forest.vox'
+        >>> vox = ptd.voxreader.voxel.from_vox(voxfile)
+        >>> cube = vox.to_cube()
+        >>> cube.shape
+        (56, 20, 20)
+
+        Plant area index of each column of voxels and vertical profile of plant area density
+
+        >>> pai = np.nansum(cube, axis=0) * vox.header['res'][2]
+        >>> profile = np.nanmean(cube, axis=(1, 2))
+        """
+        nx, ny, nz = [int(n) for n in self.header['split'][:3]]
+        k, j, i = self.data['k'].to_numpy(), self.data['j'].to_numpy(), self.data['i'].to_numpy()
+
+        cube = {}
+        for c in ([columns] if isinstance(columns, str) else columns):
+            values = self.data[c].to_numpy()
+            cube[c] = np.full((nz, ny, nx), fill_value, dtype=np.result_type(values.dtype, fill_value))
+            cube[c][k, j, i] = values
+
+        if isinstance(columns, str):
+            return cube[columns]
+        return cube
+
     def reduce_xy(self, inplace=False):
         """
         Shift the grid minimum corner to x,y=(0,0).
@@ -596,7 +913,7 @@ class voxel(object):
             grid = self.affine_transform(xy_transform, inplace=inplace)
             return grid, xy_transform
 
-    def to_plots(self, pa_type='UL', keep_columns=None, reduce_xy=False, pa_column='pad', **kwargs):
+    def to_plots(self, pa_type='UL', keep_columns=None, reduce_xy=False, pa_column='pad', from_grid=False, **kwargs):
         """
         Convert to DART plots DataFrame to be included in simulation.
 
@@ -616,6 +933,12 @@ class voxel(object):
         pa_column: str
             The plant or leaf area column name
 
+        from_grid: bool
+            If True, plots corners are extracted from the grid geometries,
+            e.g. if the grid was modified otherwise than with affine_transform.
+            Otherwise (default), they are computed from voxel indices, header and transforms, which is much faster.
+            Both give the same corners in the same order, i.e. the order of the grid polygons exterior.
+
         kwargs: for retro-compatibility
 
         Returns
@@ -657,25 +980,36 @@ class voxel(object):
 
         if reduce_xy:
             xy_transform = [1, 0, 0, 1, -self.header['min_corner'][0], -self.header['min_corner'][1]]
-            grid = self.affine_transform(xy_transform,
-                                         inplace=False)
-        else:
-            grid = self.grid
 
-        # itertuples is 10x faster than apply (already faster than iterrows)
-        # operation was tested
         # remove Ul=0 value, as it means empty voxel
-        # extract plots coordinates from grid
-        voxlist = []
-        for row in grid.itertuples():
-            voxlist.append(np.array(row.geometry.exterior.coords.xy)[:, :-1].ravel().tolist())
-        points = pd.concat([grid.loc[:, ['i', 'j']], pd.DataFrame(voxlist, columns=['PT_1_X', 'PT_2_X', 'PT_3_X',
-                                                                                    'PT_4_X', 'PT_1_Y', 'PT_2_Y',
-                                                                                    'PT_3_Y', 'PT_4_Y'])], axis=1,
-                           sort=False)
-        # merge points with data and add other parameters
         data = self.data.loc[(self.data[pa_column] != 0) & pd.notna(self.data[pa_column])].loc[:,['i', 'j', 'k', pa_column]]
-        data = data.merge(points, how='left', on=['i', 'j'])
+
+        if from_grid:
+            if reduce_xy:
+                grid = self.affine_transform(xy_transform,
+                                             inplace=False)
+            else:
+                grid = self.grid
+
+            # itertuples is 10x faster than apply (already faster than iterrows)
+            # operation was tested
+            # extract plots coordinates from grid
+            voxlist = []
+            for row in grid.itertuples():
+                voxlist.append(np.array(row.geometry.exterior.coords.xy)[:, :-1].ravel().tolist())
+            points = pd.concat([grid.loc[:, ['i', 'j']], pd.DataFrame(voxlist, columns=['PT_1_X', 'PT_2_X', 'PT_3_X',
+                                                                                        'PT_4_X', 'PT_1_Y', 'PT_2_Y',
+                                                                                        'PT_3_Y', 'PT_4_Y'])], axis=1,
+                               sort=False)
+            # merge points with data and add other parameters
+            data = data.merge(points, how='left', on=['i', 'j'])
+        else:
+            # the grid is regular: plots corners are computed from indices and transforms
+            transforms = list(self.header.get('transforms', []))
+            if reduce_xy:
+                transforms.append(xy_transform)
+            points = self._cell_corners(data['i'].to_numpy(), data['j'].to_numpy(), transforms)
+            data = pd.concat([data.reset_index(drop=True), points], axis=1, sort=False)
         data['PLT_BTM_HEI'] = data.k * res + self.header["min_corner"][2]
         data['PLT_HEI_MEA'] = res
         data['VEG_DENSITY_DEF'] = densitydef
@@ -703,6 +1037,166 @@ class voxel(object):
 
         return data
 
+    @classmethod
+    def tiles_to_plots(cls, filename, outdir, tile_size, transforms=None, pa_type='UL', keep_columns=None,
+                       reduce_xy=False, columns=None, compact=False, engine='pandas', chunk_size=1000000, ncpu=1):
+        """
+        Convert an AMAPVox file to DART plots files by xy tiles, without loading the whole voxel space.
+
+        The .vox file is read by chunks, empty voxels are dropped and the others are dispatched
+        to temporary tile files. Each tile is then converted with voxel.to_plots and written
+        to a plots file `plots_<tile_i>_<tile_j>.txt`. Tiles share the header and transforms
+        of the voxel space, thus plots coordinates are consistent between files.
+        Memory is bounded by chunk_size and tile_size.
+
+        Parameters
+        ----------
+        filename: str
+            Path to an AMAPVox .vox file
+        outdir: str
+            Directory of plots files.
+        tile_size: int
+            Number of voxels along x and y of a tile.
+        transforms: list
+            Affine transformations applied to the voxel space, see voxel.affine_transform.
+        pa_type: str
+            See voxel.to_plots.
+        keep_columns: str or list of str
+            See voxel.to_plots.
+        reduce_xy: bool
+            If True, the minimum corner of the voxel space is shifted to x,y=(0,0) in all tiles.
+        columns: list
+        compact: bool
+        engine: str
+        chunk_size: int
+            See voxel.from_vox.
+        ncpu: int
+            Number of processes converting tiles in parallel.
+
+        Returns
+        -------
+        pandas.DataFrame | (pandas.DataFrame, list)
+            Tiles with columns tile_i, tile_j, plots_file and nb_plots.
+            If reduce_xy=True, the affine_transform parameters.
+
+        Examples
+        --------
+        >>> import pytools4dart as ptd
+        >>> import tempfile
+        >>> from path import Path
+        >>> voxfile = Path(ptd.__file__).parent / 'data' / 'forest.vox'
+        >>> tiles = ptd.voxreader.voxel.tiles_to_plots(voxfile, tempfile.mkdtemp(), tile_size=10)
+        >>> int(tiles.nb_plots.sum())
+        4890
+        """
+        newVoxel = cls()
+        newVoxel.inputfile = Path(filename).expanduser()
+        newVoxel._read_vox_header()
+        header = newVoxel.header
+        outdir = Path(outdir)
+        if not outdir.is_dir():
+            raise Exception("Directory not found: '{}'. ".format(outdir))
+
+        if columns is not None:
+            columns = ['i', 'j', 'k'] + [{'pad': 'PadBVTotal'}.get(c, c) for c in columns if c not in ['i', 'j', 'k']]
+            if 'PadBVTotal' not in columns:
+                columns.append('PadBVTotal')
+
+        with tempfile.TemporaryDirectory(dir=outdir) as tempdir:
+            tempdir = Path(tempdir)
+            # dispatch voxels to tile files
+            tiles = set()
+            for chunk in newVoxel._iter_vox_chunks(columns=columns, compact=compact, engine=engine,
+                                                   chunk_size=chunk_size):
+                chunk = chunk.rename(columns={'PadBVTotal': 'pad'})
+                for (ti, tj), tile in chunk.groupby([chunk.i // tile_size, chunk.j // tile_size]):
+                    tile_file = tempdir / 'tile_{}_{}.csv'.format(ti, tj)
+                    tile.to_csv(tile_file, index=False, mode='a', header=(ti, tj) not in tiles)
+                    tiles.add((ti, tj))
+
+            kwargs = dict(pa_type=pa_type, keep_columns=keep_columns, reduce_xy=reduce_xy)
+            args = [(header, transforms, tempdir / 'tile_{}_{}.csv'.format(ti, tj),
+                     outdir / 'plots_{}_{}.txt'.format(ti, tj), kwargs) for ti, tj in sorted(tiles)]
+            if ncpu > 1:
+                with Pool(ncpu) as pool:
+                    nb_plots = pool.map(_tile_to_plots, args)
+            else:
+                nb_plots = [_tile_to_plots(a) for a in args]
+
+        tiles = pd.DataFrame(sorted(tiles), columns=['tile_i', 'tile_j'])
+        tiles['plots_file'] = [a[3] for a in args]
+        tiles['nb_plots'] = nb_plots
+
+        if reduce_xy:
+            return tiles, [1, 0, 0, 1, -header['min_corner'][0], -header['min_corner'][1]]
+        return tiles
+
+    def _cell_corners(self, i, j, transforms=None):
+        """
+        Corner coordinates of grid cells, in the order of the cell polygons exterior (see shapely.box),
+        i.e. (xmax, ymin), (xmax, ymax), (xmin, ymax), (xmin, ymin) before transformation.
+
+        Parameters
+        ----------
+        i, j: numpy.ndarray
+            Cell indices.
+        transforms: list
+            Affine transformations applied successively to the corners, see affine_transform.
+
+        Returns
+        -------
+        pandas.DataFrame
+            Columns PT_1_X, PT_2_X, PT_3_X, PT_4_X, PT_1_Y, PT_2_Y, PT_3_Y, PT_4_Y.
+        """
+        res = self.header["res"][0]
+        xmin = i * res + self.header["min_corner"][0]
+        ymin = j * res + self.header["min_corner"][1]
+        xmax = (i + 1) * res + self.header["min_corner"][0]
+        ymax = (j + 1) * res + self.header["min_corner"][1]
+        x = np.stack([xmax, xmax, xmin, xmin])
+        y = np.stack([ymin, ymax, ymax, ymin])
+        if transforms is not None:
+            for a, b, d, e, xoff, yoff in transforms:
+                x, y = a * x + b * y + xoff, d * x + e * y + yoff
+        columns = ['PT_{}_X'.format(n) for n in range(1, 5)] + ['PT_{}_Y'.format(n) for n in range(1, 5)]
+        return pd.DataFrame(np.vstack([x, y]).T.astype(float), columns=columns)
+
+    def _aggregate_cube(self, aggregate_fun):
+        """
+        Aggregate pad of each column of voxels, see voxel.to_raster.
+
+        Returns
+        -------
+        numpy.ndarray
+            Aggregated values indexed [j, i].
+        """
+        cube = self.to_cube('pad', fill_value=np.nan)
+        valid = ~np.isnan(cube)
+        count = valid.sum(axis=0)
+        empty = count == 0
+        if aggregate_fun == 'sum':
+            img = np.nansum(cube, axis=0)
+        elif aggregate_fun == 'max':
+            img = np.fmax.reduce(cube, axis=0)
+        elif aggregate_fun == 'mean':
+            img = np.nansum(cube, axis=0) / np.maximum(count, 1)
+        elif aggregate_fun.startswith('top') and aggregate_fun[3:].isdigit():
+            # rank of non-empty voxels from the top of the column
+            filled = valid & (cube > 0)
+            rank = np.cumsum(filled[::-1], axis=0)[::-1]
+            img = np.where(filled & (rank <= int(aggregate_fun[3:])), cube, 0).sum(axis=0)
+        elif aggregate_fun == 'hmax':
+            kmax = np.where(valid, cube, -np.inf).argmax(axis=0)
+            img = self.header['min_corner'][2] + (kmax + .5) * self.header['res'][-1]
+            # columns without vegetation have no height
+            empty = empty | ~(valid & (cube > 0)).any(axis=0)
+        else:
+            raise ValueError("Unknown aggregation '{}', expected 'sum', 'max', 'mean', 'top<N>' or 'hmax'."
+                             .format(aggregate_fun))
+        img = img.astype(float)
+        img[empty] = np.nan
+        return img
+
     def to_raster(self, raster_file, crs=None, use_transform=True,
                   aggregate_fun=None, reproject=False):
         """
@@ -716,8 +1210,17 @@ class voxel(object):
             Coordinates reference system.
         use_transform: bool
             If True, the transformations stored in self.header are applied.
-        aggregate_fun: function
-            Function to aggregate the LAI/LAD values.
+        aggregate_fun: str or function
+            Aggregation of the pad values of each column of voxels, computed on the dense voxel cube if a str:
+                - 'sum': sum of pad
+                - 'max': maximum of pad
+                - 'mean': mean of pad
+                - 'top<N>', e.g. 'top3': sum of pad of the N highest non-empty voxels
+                - 'hmax': height of the center of the voxel of maximum pad, NaN if pad is 0 in the whole column
+            Columns without pad values are set to NaN.
+            A function is applied to the data of each column of voxels (slower), e.g.
+            `lambda x: x['pad'].sum()`.
+            If None, the raster has one band per voxel layer.
         reproject: bool
             If True and the transformation contains a rotation,
             the raster is regridded on an x,y grid,
@@ -746,6 +1249,10 @@ class voxel(object):
         >>> ivop2D = (ivop[0,0],ivop[0,1],ivop[1,0],ivop[1,1],ivop[0,3],ivop[1,3])
         >>> vox.affine_transform(ivop2D, inplace=True)
         >>> raster_file = vox.to_raster('/tmp/test.tif', crs = '+init=epsg:2792')
+
+        Plant area density summed over each column of voxels
+
+        >>> raster_file = vox.to_raster('/tmp/test_sum.tif', crs = '+init=epsg:2792', aggregate_fun='sum')
         """
         # TODO: change to geocube
         # at the moment failed install conda-forge geocube on current conda env...
@@ -757,12 +1264,12 @@ class voxel(object):
 
         xdim = int(self.header['split'][0])
         ydim = int(self.header['split'][1])
-        zdim = int(self.header['split'][2])
-        vdata = self.data[['i', 'j', 'k', 'pad']].copy().reset_index(drop=True)
-        vdata['row'] = ydim - 1 - vdata['j']
-        vdata['col'] = vdata['i']
 
-        if aggregate_fun is not None:
+        if isinstance(aggregate_fun, str):
+            # rows are flipped: row = ydim - 1 - j
+            img = self._aggregate_cube(aggregate_fun)[::-1, :]
+
+        elif aggregate_fun is not None:
             # %%time
             # img = np.zeros(xdim * ydim).reshape(1, ydim, xdim)
             # growcol = vdata.groupby(['row', 'col'])
@@ -770,13 +1277,15 @@ class voxel(object):
             #     row, col = g[0]
             #     img[0, row, col] = aggregate_fun(g[1])
             # %%time
+            vdata = self.data[['i', 'j', 'k', 'pad']].copy().reset_index(drop=True)
+            vdata['row'] = ydim - 1 - vdata['j']
+            vdata['col'] = vdata['i']
             growcol = vdata.groupby(['row', 'col'])
             img = growcol.apply(aggregate_fun).to_xarray()
-            img.reindex({'row': np.arange(ydim), 'col':np.arange(xdim)})
+            img = img.reindex({'row': np.arange(ydim), 'col': np.arange(xdim)}).data
 
         else:
-            img = vdata.set_index(['k', 'row', 'col'])['pad'].to_xarray()
-            img.reindex({'k': np.arange(zdim), 'row': np.arange(ydim), 'col': np.arange(xdim)})
+            img = self.to_cube('pad', fill_value=np.nan)[:, ::-1, :]
 
 
         res = self.header['res'][0]
@@ -791,10 +1300,10 @@ class voxel(object):
                 a, b, d, e, c, f = t
                 transform = Affine(a, b, c, d, e, f) * transform
 
-        if img.data.ndim==2:
-            data = img.data.reshape((1, img.data.shape[0], img.data.shape[1]))
+        if img.ndim==2:
+            data = img.reshape((1, img.shape[0], img.shape[1]))
         else:
-            data = img.data
+            data = np.ascontiguousarray(img)
 
         with rasterio.open(
                 raster_file,
@@ -817,6 +1326,104 @@ class voxel(object):
 
         return raster_file
 
+def _tile_to_plots(args):
+    """
+    Convert a tile file of voxels to a plots file, see voxel.tiles_to_plots.
+
+    Parameters
+    ----------
+    args: tuple
+        (header, transforms, tile_file, plots_file, kwargs of voxel.to_plots)
+
+    Returns
+    -------
+    int
+        Number of plots
+    """
+    header, transforms, tile_file, plots_file, kwargs = args
+    tile = voxel()
+    tile.header = dict(header)
+    tile.data = pd.read_csv(tile_file, float_precision='round_trip')
+    tile._create_grid()
+    for t in (transforms or []):
+        tile.affine_transform(t, inplace=True)
+    plots = tile.to_plots(**kwargs)
+    if kwargs.get('reduce_xy'):
+        plots = plots[0]
+
+    with open(plots_file, mode='w') as f:
+        f.write(PLOTS_HEADER)
+    plots.to_csv(plots_file, sep='\t', index=False, mode='a', header=True)
+    return len(plots)
+
+
+def _compose_transforms(transforms):
+    """
+    Compose 2D affine transformations.
+
+    Parameters
+    ----------
+    transforms: list
+        Transformations [a, b, d, e, xoff, yoff] in the order they are applied.
+
+    Returns
+    -------
+    tuple
+        (a, b, d, e, xoff, yoff) of the composed transformation.
+    """
+    a, b, d, e, xoff, yoff = transforms[0]
+    for a2, b2, d2, e2, xoff2, yoff2 in transforms[1:]:
+        a, b, d, e, xoff, yoff = (a2 * a + b2 * d, a2 * b + b2 * e, d2 * a + e2 * d, d2 * b + e2 * e,
+                                  a2 * xoff + b2 * yoff + xoff2, d2 * xoff + e2 * yoff + yoff2)
+    return a, b, d, e, xoff, yoff
+
+
+def _affine_transform(geometries, matrix):
+    """
+    Apply a 2D affine transformation to an array of geometries at once,
+    with the same equations as shapely.affinity.affine_transform.
+
+    Parameters
+    ----------
+    geometries: numpy.ndarray or geopandas.array.GeometryArray
+    matrix: tuple
+        [a, b, d, e, xoff, yoff]
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    a, b, d, e, xoff, yoff = matrix
+
+    def _affine_coords(coords):
+        x, y = coords.T
+        return np.stack([a * x + b * y + xoff, d * x + e * y + yoff]).T
+
+    return shapely.transform(np.asarray(geometries), _affine_coords)
+
+
+def _xy_to_colrow(transform, x, y):
+    """
+    Column and row of the pixels containing points x, y.
+
+    Parameters
+    ----------
+    transform: rasterio.transform.Affine
+        Raster transform
+    x, y: numpy.ndarray
+        Coordinates of points
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        col, row
+    """
+    T = ~transform
+    col = np.floor(T.a * x + T.b * y + T.c).astype(int)
+    row = np.floor(T.d * x + T.e * y + T.f).astype(int)
+    return col, row
+
+
 def _reproject_without_rotation(src_file, dst_file):
     with rasterio.open(src_file) as src:
         resx = np.sqrt(src.transform.a ** 2 + src.transform.b ** 2)